@@ -1,40 +1,43 @@
 import sys
-import os
 import asyncio
-import subprocess
-import threading
-from server import start_server, P2PServer
+import time
 import signal
+from control import ControlClient, ControlError, read_pid
 
 class NexPingDaemon:
     def __init__(self):
         self.server = None
-        self.is_running = False
 
     def start(self):
         """Start the NexPing server"""
-        if self.is_running:
-            print("Server is already running")
+        pid = read_pid()
+        if pid:
+            print(f"Server is already running (pid {pid})")
             return
         
+        from server import start_server
+        
         print("Starting NexPing P2P Messenger...")
-        print("Initializing database...")
-        print("Starting P2P network...")
         print("Web interface: http://localhost:2947")
-        
-        self.is_running = True
-        self.server = start_server()
+        start_server()
 
-    def stop(self):
-        """Stop the NexPing server"""
-        if not self.is_running:
+    def stop(self, timeout=10):
+        """Ask the running server to shut down and wait for it to exit"""
+        try:
+            with ControlClient() as client:
+                reply = client.request('stop')
+        except (ControlError, OSError):
             print("Server is not running")
             return
         
         print("Stopping NexPing server...")
-        self.is_running = False
-        
-        os._exit(0)
+        deadline = time.monotonic() + timeout
+        while read_pid() == reply['pid'] and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if read_pid() == reply['pid']:
+            print(f"Server did not stop within {timeout}s (pid {reply['pid']})")
+        else:
+            print("Server stopped")
 
 def print_help():
     print("NexPing P2P Messenger - Private Network")
@@ -44,6 +47,11 @@ def print_help():
     print("  nex version  - Show version")
     print("  nex status   - Show network status")
     print("  nex contacts - List discovered contacts")
+    print("  nex watch [seconds]   - Live throughput and peer counts")
+    print("  nex relay [port]      - Run a message relay server (default 2949)")
+    print("  nex profile [seconds] - Profile the running server")
+    print("  nex export [file]     - Export chat history (NDJSON, .gz compresses)")
+    print("  nex import <file>     - Import an export file")
 
 def show_version():
     print("NexPing v2.0.0")
@@ -51,20 +59,118 @@ def show_version():
     print("Network: NexPing Private P2P Network")
     print("Features: E2EE, SQLite, Real P2P, UDP Discovery")
 
-async def check_status():
+def control_request(command, timeout=5, **args):
+    """Run one control command; prints and returns None if the server is not reachable"""
+    try:
+        with ControlClient(timeout=timeout) as client:
+            return client.request(command, **args)
+    except ControlError as e:
+        print(f"Status: {e}" if str(e) == "NexPing is not running" else f"Error: {e}")
+    except OSError as e:
+        print(f"Error: {e}")
+    return None
+
+def check_status():
     """Check server status"""
+    data = control_request('status')
+    if not data:
+        return
+    
+    stats = data['stats']
+    print(f"Status: Server is running (pid {data['pid']}, up {int(data['uptime'])}s)")
+    print(f"Node: {data['name']} ({data['node_id']})")
+    print(f"Web interface: {data['web']}")
+    print(f"Public address: {data['public_address'] or 'unknown'}")
+    print(f"Peers: {data['peers']['online']} online, {data['peers']['known']} known")
+    print(f"Messages: {stats.get('messages_in', 0)} in, {stats.get('messages_out', 0)} out, "
+          f"{stats.get('duplicates', 0)} duplicates dropped")
+    print(f"Active transfers: {data['transfers']}")
+    for relay in data['relays']:
+        health = 'ok' if relay['healthy'] else f"backing off ({relay['failures']} failures)"
+        latency = f"{relay['latency_ms']} ms" if relay['latency_ms'] is not None else 'untested'
+        print(f"Relay {relay['url']}: {health}, {latency}")
+
+def list_contacts():
+    """Print the contact list"""
+    data = control_request('contacts')
+    if not data:
+        return
+    
+    contacts = data['contacts']
+    if not contacts:
+        print("No contacts discovered yet")
+        return
+    for contact in contacts:
+        status = 'online ' if contact['online'] else 'offline'
+        unread = f"  ({contact['unread_count']} unread)" if contact['unread_count'] else ''
+        print(f"{status}  {contact['node_id']}  {contact['name']:<20} {contact['address'] or '-'}{unread}")
+
+def watch(interval):
+    """Stream live stats until interrupted"""
+    try:
+        with ControlClient(timeout=interval + 5) as client:
+            print(f"{'peers':>11} {'pkt in/s':>9} {'pkt out/s':>9} {'kB in/s':>8} {'kB out/s':>8} {'msg in/s':>8} {'msg out/s':>9}")
+            for data in client.stream('watch', interval=interval):
+                peers, rates = data['peers'], data['rates']
+                print(f"{peers['online']:>5}/{peers['known']:<5} {rates['packets_in']:>9} {rates['packets_out']:>9} "
+                      f"{rates['bytes_in'] / 1024:>8.1f} {rates['bytes_out'] / 1024:>8.1f} "
+                      f"{rates['messages_in']:>8} {rates['messages_out']:>9}")
+    except ControlError as e:
+        print(f"Status: {e}")
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+
+def run_profile(seconds):
+    """Ask the running server to profile itself"""
+    data = control_request('profile', timeout=seconds + 30, seconds=seconds)
+    if not data:
+        return
+    
+    lag = data['loop_lag']
+    print(f"Profiled {data['seconds']}s, {data['samples']} stack samples")
+    print(f"Event loop lag: mean {lag.get('mean_ms')} ms, p99 {lag.get('p99_ms')} ms, max {lag.get('max_ms')} ms")
+    print(f"Slow callbacks (>{data['slow_callbacks']['threshold_ms']} ms): {data['slow_callbacks']['count']}")
+    for callback in data['slow_callbacks']['examples'][:5]:
+        print(f"  {callback}")
+    print("Hot paths (cumulative):")
+    for row in data['hot_paths'][:10]:
+        print(f"  {row['cumulative_ms']:>10.1f} ms  {row['calls']:>7} calls  {row['function']}")
+    for kind, path in data['files'].items():
+        print(f"{kind}: {path}")
+
+async def export_history(path):
+    """Export the local database without going through the server"""
+    from database import Database
+    from backup import export_to_file
+    
+    db = Database()
+    await db.init_db()
+    counts = await export_to_file(db, path)
+    print(f"Exported to {path}: " + ", ".join(f"{n} {table}" for table, n in counts.items()))
+
+async def import_history(path):
+    """Import an export file into the local database"""
+    from database import Database
+    from backup import import_from_file, BackupError
+    
+    db = Database()
+    await db.init_db()
     try:
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.get('http://localhost:2947/contacts') as resp:
-                if resp.status == 200:
-                    print("Status: Server is running")
-                    data = await resp.json()
-                    print(f"Node ID: {data.get('node_id', 'Unknown')}")
-                    print(f"Contacts: {len(data.get('contacts', []))} discovered")
-                    return
-    except:
-        print("Status: Server is not running")
+        counts = await import_from_file(db, path)
+    except (OSError, BackupError) as e:
+        print(f"Import failed: {e}")
+        return
+    print(f"Imported from {path}: " + ", ".join(f"{n} {table}" for table, n in counts.items()))
+
+def number_arg(convert, default, low, high):
+    """Optional numeric argument after the command; None if it is invalid"""
+    if len(sys.argv) < 3:
+        return default
+    try:
+        value = convert(sys.argv[2])
+    except ValueError:
+        return None
+    return value if low <= value <= high else None
 
 def main():
     if len(sys.argv) < 2:
@@ -81,9 +187,36 @@ def main():
     elif command == "version":
         show_version()
     elif command == "status":
-        asyncio.run(check_status())
+        check_status()
+    elif command == "profile":
+        seconds = number_arg(float, 10, 0.1, 300)
+        if seconds is None:
+            print("Usage: nex profile [seconds]   (0.1-300)")
+            return
+        run_profile(seconds)
+    elif command == "export":
+        path = sys.argv[2] if len(sys.argv) > 2 else "nexping-export.ndjson.gz"
+        asyncio.run(export_history(path))
+    elif command == "import":
+        if len(sys.argv) < 3:
+            print("Usage: nex import <file>")
+            return
+        asyncio.run(import_history(sys.argv[2]))
     elif command == "contacts":
-        print("Use web interface at http://localhost:2947 to view contacts")
+        list_contacts()
+    elif command == "relay":
+        from relay import run_relay, RELAY_PORT
+        port = number_arg(int, RELAY_PORT, 1, 65535)
+        if port is None:
+            print("Usage: nex relay [port]   (1-65535)")
+            return
+        run_relay(port=port)
+    elif command == "watch":
+        interval = number_arg(float, 1.0, 0.1, 60)
+        if interval is None:
+            print("Usage: nex watch [seconds]   (0.1-60)")
+            return
+        watch(interval)
     else:
         print(f"Unknown command: {command}")
         print_help()
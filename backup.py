@@ -0,0 +1,90 @@
+import gzip
+import json
+import zlib
+from datetime import datetime
+
+EXPORT_FORMAT = 'nexping-export'
+EXPORT_VERSION = 1
+WRITE_CHUNK = 64 * 1024
+
+
+class BackupError(Exception):
+    pass
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+async def export_ndjson(db, write, compress=False, batch_size=1000):
+    """Stream the database as NDJSON through `await write(bytes)`.
+
+    Lines are grouped into ~64 KiB chunks and optionally gzip-compressed on
+    the fly, so memory use does not depend on the number of rows.
+    Returns the number of rows written per table.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    buffered = 0
+    counts = {}
+
+    async def emit(line):
+        nonlocal buffered
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= WRITE_CHUNK:
+            await flush()
+
+    async def flush():
+        nonlocal buffered
+        if not buffer:
+            return
+        data = b''.join(buffer)
+        buffer.clear()
+        buffered = 0
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            await write(data)
+
+    header = {'format': EXPORT_FORMAT, 'version': EXPORT_VERSION,
+              'exported_at': datetime.now().isoformat()}
+    await emit(json.dumps(header).encode('utf-8') + b'\n')
+    async for table, row in db.export_rows(batch_size):
+        record = {'table': table, 'row': row}
+        await emit(json.dumps(record, ensure_ascii=False, default=_json_default).encode('utf-8') + b'\n')
+        counts[table] = counts.get(table, 0) + 1
+    await flush()
+    if compressor:
+        await write(compressor.flush())
+    return counts
+
+
+async def export_to_file(db, path):
+    """Export to a file; a .gz suffix enables compression"""
+    with open(path, 'wb') as f:
+        async def write(data):
+            f.write(data)
+        return await export_ndjson(db, write, compress=path.endswith('.gz'))
+
+
+async def read_ndjson(path):
+    """Yield (table, row) from an export file, one line at a time"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline() or '{}')
+        if header.get('format') != EXPORT_FORMAT:
+            raise BackupError(f"{path} is not a NexPing export")
+        if header.get('version', 0) > EXPORT_VERSION:
+            raise BackupError(f"Unsupported export version {header.get('version')}")
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record['table'], record['row']
+
+
+async def import_from_file(db, path, batch_size=1000):
+    """Import an export file in batched transactions; returns rows read per table"""
+    return await db.import_rows(read_ndjson(path), batch_size)
\ No newline at end of file
@@ -0,0 +1,504 @@
+"""Loopback load generator for the NexPing P2P and database pipeline.
+
+Starts a real P2PServer on 127.0.0.1 with a temporary database, drives it
+with simulated peers over UDP and records ingest throughput, send-to-commit
+latency, HTTP latency and memory. Results are written as JSON so runs can be
+compared:
+
+    python benchmark.py --peers 20 --rate 500 --duration 15 --output run.json
+    python benchmark.py --output new.json --compare run.json
+
+`--scenario relay` instead load-tests the HTTP relay: an in-process
+RelayServer, `--peers` RelayClients sending to one long-polling receiver.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import aiohttp
+import aiosqlite
+
+from logger import setup_logging, shutdown_logging
+from relay import RelayClient, start_relay
+from server import P2PServer
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    """Ask the OS for an unused loopback port"""
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    ms = [round(v * 1000, 3) for v in samples]
+    return {
+        'count': len(ms),
+        'p50_ms': percentile(ms, 50),
+        'p90_ms': percentile(ms, 90),
+        'p99_ms': percentile(ms, 99),
+        'max_ms': max(ms) if ms else None,
+    }
+
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class SimulatedPeers:
+    """A set of fake nodes sending datagrams from their own UDP sockets"""
+
+    def __init__(self, count, target, rate, keep_alive_rate, discovery_rate, message_size):
+        self.target = target
+        self.rate = rate
+        self.keep_alive_rate = keep_alive_rate
+        self.discovery_rate = discovery_rate
+        self.message_size = message_size
+        self.peers = []
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            node_id = os.urandom(8).hex()
+            self.peers.append((node_id, sock))
+        self.sent = {'discovery': 0, 'keep_alive': 0, 'message': 0, 'dropped_local': 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def send(self, sock, message):
+        try:
+            sock.sendto(json.dumps(message).encode('utf-8'), self.target)
+            self.sent[message['type']] += 1
+        except (BlockingIOError, OSError):
+            self.sent['dropped_local'] += 1
+
+    def discovery(self, node_id):
+        return {
+            'type': 'discovery',
+            'node_id': node_id,
+            'name': f"Bench_{node_id[:8]}",
+            'public_ip': '127.0.0.1',
+            'public_port': None,
+            'timestamp': datetime.now().isoformat()
+        }
+
+    def announce(self):
+        """Send one discovery per peer so the server knows every contact"""
+        for node_id, sock in self.peers:
+            self.send(sock, self.discovery(node_id))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        for _, sock in self.peers:
+            sock.close()
+
+    def _run(self):
+        # Paced in 10 ms ticks; fractional sends carry over between ticks
+        tick = 0.01
+        budget = {'message': 0.0, 'keep_alive': 0.0, 'discovery': 0.0}
+        rates = {
+            'message': self.rate,
+            'keep_alive': self.keep_alive_rate,
+            'discovery': self.discovery_rate,
+        }
+        filler = 'x' * self.message_size
+        seq = 0
+        next_tick = time.perf_counter()
+        while not self._stop.is_set():
+            for kind, rate in rates.items():
+                budget[kind] += rate * tick
+                while budget[kind] >= 1:
+                    budget[kind] -= 1
+                    node_id, sock = random.choice(self.peers)
+                    if kind == 'message':
+                        seq += 1
+                        message = {
+                            'type': 'message',
+                            'from': node_id,
+                            'to': 'bench',
+                            'content': f"{seq} {filler}",
+                            'timestamp': datetime.now().isoformat(),
+                            'sent_at': time.perf_counter()
+                        }
+                    elif kind == 'keep_alive':
+                        message = {
+                            'type': 'keep_alive',
+                            'node_id': node_id,
+                            'timestamp': datetime.now().isoformat()
+                        }
+                    else:
+                        message = self.discovery(node_id)
+                    self.send(sock, message)
+            next_tick += tick
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def instrument_ingest(network, latencies):
+    """Time each `message` from the peer's send until its handler (and DB commit) returns.
+
+    The peers run in this process, so their `sent_at` is on the same
+    perf_counter clock and the time a datagram waits in the socket buffer
+    is counted too.
+    """
+    original = network.handle_p2p_message
+
+    async def timed_handle_p2p_message(message, addr):
+        await original(message, addr)
+        sent_at = message.get('sent_at')
+        if isinstance(sent_at, float):
+            latencies.append(time.perf_counter() - sent_at)
+
+    network.handle_p2p_message = timed_handle_p2p_message
+
+
+async def probe_http(base_url, node_ids, results, stop, interval):
+    """Poll the HTTP API like the web UI does and time each request"""
+    async with aiohttp.ClientSession() as session:
+        while not stop.is_set():
+            for path, params in (
+                ('/contacts', None),
+                ('/messages', {'contact_node_id': random.choice(node_ids)}),
+            ):
+                started = time.perf_counter()
+                try:
+                    async with session.get(base_url + path, params=params) as resp:
+                        await resp.read()
+                        if resp.status == 200:
+                            results[path].append(time.perf_counter() - started)
+                        else:
+                            results['errors'] += 1
+                except aiohttp.ClientError:
+                    results['errors'] += 1
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def sample_memory(samples, stop, started, interval):
+    while not stop.is_set():
+        samples.append([round(time.perf_counter() - started, 3), current_rss()])
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def count_messages(db):
+    async with aiosqlite.connect(db.db_path) as conn:
+        cursor = await conn.execute('SELECT COUNT(*) FROM messages')
+        return (await cursor.fetchone())[0]
+
+
+async def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='nexping-bench-')
+    db_path = os.path.join(workdir, 'bench.db')
+    web_port = args.web_port or free_port()
+    p2p_port = args.p2p_port or free_port(socket.SOCK_DGRAM)
+
+    server = P2PServer(host='127.0.0.1', web_port=web_port, p2p_port=p2p_port,
+                       db_path=db_path, use_stun=False, control_socket=None)
+    await server.start()
+    await server.start_web_interface()
+
+    latencies = []
+    instrument_ingest(server.network, latencies)
+
+    peers = SimulatedPeers(
+        args.peers, ('127.0.0.1', p2p_port), args.rate,
+        args.keep_alive_rate, args.discovery_rate, args.message_size
+    )
+    peers.announce()
+    # Let discovery land so the first messages have a contact to attach to
+    deadline = time.perf_counter() + 10
+    while len(server.network.peers) < args.peers and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)
+    latencies.clear()
+
+    http = {'/contacts': [], '/messages': [], 'errors': 0}
+    memory = []
+    stop = asyncio.Event()
+    started = time.perf_counter()
+    baseline_messages = await count_messages(server.db)
+    tasks = [
+        asyncio.create_task(probe_http(f"http://127.0.0.1:{web_port}",
+                                       [n for n, _ in peers.peers], http, stop, args.http_interval)),
+        asyncio.create_task(sample_memory(memory, stop, started, args.memory_interval)),
+    ]
+
+    peers.start()
+    await asyncio.sleep(args.duration)
+    await asyncio.get_running_loop().run_in_executor(None, peers.stop)
+    load_elapsed = time.perf_counter() - started
+
+    # Drain whatever is still queued in the socket buffer
+    previous = -1
+    stored = await count_messages(server.db) - baseline_messages
+    drain_deadline = time.perf_counter() + args.drain_timeout
+    while stored != previous and time.perf_counter() < drain_deadline:
+        previous = stored
+        await asyncio.sleep(0.5)
+        stored = await count_messages(server.db) - baseline_messages
+    total_elapsed = time.perf_counter() - started
+
+    stop.set()
+    await asyncio.gather(*tasks)
+    await server.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    sent = dict(peers.sent)
+    rss = [m[1] for m in memory]
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'peers': args.peers,
+            'rate': args.rate,
+            'keep_alive_rate': args.keep_alive_rate,
+            'discovery_rate': args.discovery_rate,
+            'message_size': args.message_size,
+            'duration': args.duration,
+        },
+        'sent': sent,
+        'ingest': {
+            'stored': stored,
+            'loss_ratio': round(1 - stored / sent['message'], 4) if sent['message'] else None,
+            'load_seconds': round(load_elapsed, 3),
+            'total_seconds': round(total_elapsed, 3),
+            'throughput_msgs_per_s': round(stored / total_elapsed, 2) if total_elapsed else None,
+        },
+        'latency': summarize(latencies),
+        'http': {
+            'contacts': summarize(http['/contacts']),
+            'messages': summarize(http['/messages']),
+            'errors': http['errors'],
+        },
+        'memory': {
+            'start_rss': rss[0] if rss else None,
+            'peak_rss': max(rss) if rss else None,
+            'end_rss': rss[-1] if rss else None,
+            'samples': memory,
+        },
+    }
+
+
+async def run_relay_benchmark(args):
+    port = free_port()
+    relay, runner = await start_relay('127.0.0.1', port)
+    url = f"http://127.0.0.1:{port}"
+
+    latencies = []
+    memory = []
+    stop = asyncio.Event()
+    received = 0
+
+    async def on_message(message):
+        nonlocal received
+        received += 1
+        latencies.append(time.perf_counter() - message['sent_at'])
+
+    receiver = RelayClient('bench-receiver', [url])
+    poller = asyncio.create_task(receiver.poll(on_message, wait=5))
+    senders = [RelayClient(f"bench-{i:04d}", [url]) for i in range(args.peers)]
+    content = 'x' * args.message_size
+    sends = []
+
+    started = time.perf_counter()
+    sampler = asyncio.create_task(sample_memory(memory, stop, started, args.memory_interval))
+    sent = 0
+    tick = 0.01
+    while time.perf_counter() - started < args.duration:
+        due = int((time.perf_counter() - started) * args.rate) - sent
+        for _ in range(due):
+            sender = senders[sent % len(senders)]
+            message = {'type': 'message', 'from': sender.node_id, 'content': content,
+                       'sent_at': time.perf_counter()}
+            sends.append(asyncio.ensure_future(sender.send_via_relay('bench-receiver', message)))
+            sent += 1
+        await asyncio.sleep(tick)
+    accepted = sum(await asyncio.gather(*sends))
+    load_elapsed = time.perf_counter() - started
+
+    drain_deadline = time.perf_counter() + args.drain_timeout
+    while received < accepted and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.05)
+    total_elapsed = time.perf_counter() - started
+
+    stop.set()
+    await sampler
+    poller.cancel()
+    await asyncio.gather(poller, return_exceptions=True)
+    requests = sum(sender.requests for sender in senders)
+    for client in senders + [receiver]:
+        await client.close()
+    await runner.cleanup()
+
+    rss = [m[1] for m in memory]
+    return {
+        'scenario': 'relay',
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'peers': args.peers,
+            'rate': args.rate,
+            'message_size': args.message_size,
+            'duration': args.duration,
+        },
+        'relay': {
+            'sent': sent,
+            'accepted': accepted,
+            'received': received,
+            'loss_ratio': round(1 - received / sent, 4) if sent else None,
+            'requests': requests,
+            'messages_per_request': round(accepted / requests, 2) if requests else None,
+            'load_seconds': round(load_elapsed, 3),
+            'total_seconds': round(total_elapsed, 3),
+            'throughput_msgs_per_s': round(received / total_elapsed, 2) if total_elapsed else None,
+            'server': dict(relay.stats),
+        },
+        'latency': summarize(latencies),
+        'memory': {
+            'start_rss': rss[0] if rss else None,
+            'peak_rss': max(rss) if rss else None,
+            'end_rss': rss[-1] if rss else None,
+            'samples': memory,
+        },
+    }
+
+
+# (path into the result, True if higher is better)
+COMPARED_METRICS = [
+    (('ingest', 'throughput_msgs_per_s'), True),
+    (('relay', 'throughput_msgs_per_s'), True),
+    (('latency', 'p50_ms'), False),
+    (('latency', 'p99_ms'), False),
+    (('http', 'contacts', 'p99_ms'), False),
+    (('http', 'messages', 'p99_ms'), False),
+    (('memory', 'peak_rss'), False),
+]
+
+
+def compare(current, previous, tolerance):
+    """Print metric deltas against a previous run; return the list of regressions"""
+    regressions = []
+    print(f"{'metric':32} {'previous':>14} {'current':>14} {'change':>9}")
+    for path, higher_is_better in COMPARED_METRICS:
+        old, new = previous, current
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        name = '.'.join(path)
+        if not old or new is None:
+            print(f"{name:32} {str(old):>14} {str(new):>14} {'n/a':>9}")
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        print(f"{name:32} {old:>14.2f} {new:>14.2f} {change:>+8.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NexPing loopback benchmark')
+    parser.add_argument('--scenario', choices=['p2p', 'relay'], default='p2p',
+                        help='UDP ingest into a server, or the HTTP relay')
+    parser.add_argument('--peers', type=int, default=20, help='simulated peers')
+    parser.add_argument('--rate', type=float, default=200, help='message datagrams per second')
+    parser.add_argument('--keep-alive-rate', type=float, default=20, help='keep_alive datagrams per second')
+    parser.add_argument('--discovery-rate', type=float, default=2, help='discovery datagrams per second')
+    parser.add_argument('--message-size', type=int, default=64, help='message content length')
+    parser.add_argument('--duration', type=float, default=10, help='load phase in seconds')
+    parser.add_argument('--drain-timeout', type=float, default=10, help='max seconds to wait for the backlog')
+    parser.add_argument('--http-interval', type=float, default=0.5, help='seconds between HTTP probes')
+    parser.add_argument('--memory-interval', type=float, default=0.5, help='seconds between RSS samples')
+    parser.add_argument('--web-port', type=int, default=0)
+    parser.add_argument('--p2p-port', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json', help='where to write the JSON result')
+    parser.add_argument('--compare', help='previous result JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed relative regression')
+    args = parser.parse_args()
+
+    setup_logging(level='WARNING')
+    try:
+        runner = run_relay_benchmark if args.scenario == 'relay' else run_benchmark
+        result = asyncio.run(runner(args))
+    finally:
+        shutdown_logging()
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    latency = result['latency']
+    if args.scenario == 'relay':
+        stats = result['relay']
+        print(f"Sent: {stats['sent']} messages, accepted: {stats['accepted']}, received: {stats['received']} "
+              f"(loss {stats['loss_ratio']})")
+        print(f"Throughput: {stats['throughput_msgs_per_s']} msg/s in {stats['requests']} requests "
+              f"({stats['messages_per_request']} msg/request)")
+        print(f"Send-to-receive latency: p50 {latency['p50_ms']} ms, p99 {latency['p99_ms']} ms")
+    else:
+        print_ingest(result)
+    print(f"Peak RSS: {result['memory']['peak_rss']} bytes")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare(result, previous, args.tolerance):
+            sys.exit(1)
+
+
+def print_ingest(result):
+    ingest = result['ingest']
+    latency = result['latency']
+    print(f"Sent: {result['sent']['message']} messages, stored: {ingest['stored']} "
+          f"(loss {ingest['loss_ratio']})")
+    print(f"Throughput: {ingest['throughput_msgs_per_s']} msg/s")
+    print(f"Ingest latency: p50 {latency['p50_ms']} ms, p99 {latency['p99_ms']} ms")
+    print(f"HTTP /contacts p99: {result['http']['contacts']['p99_ms']} ms, "
+          f"/messages p99: {result['http']['messages']['p99_ms']} ms")
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import os
+import socket
+import time
+
+from logger import get_logger
+
+log = get_logger('control')
+
+SOCKET_PATH = os.environ.get('NEXPING_SOCKET', 'nexping.sock')
+# Stats reported by `watch` as per-second rates
+RATE_KEYS = ('packets_in', 'packets_out', 'bytes_in', 'bytes_out', 'messages_in', 'messages_out')
+
+
+class ControlError(Exception):
+    pass
+
+
+def pid_path(socket_path):
+    return os.path.splitext(socket_path)[0] + '.pid'
+
+
+def read_pid(socket_path=SOCKET_PATH):
+    """PID of the running daemon from its pidfile, or None"""
+    try:
+        with open(pid_path(socket_path)) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    return pid
+
+
+class ControlServer:
+    """Newline-delimited JSON command socket served by a running P2PServer.
+
+    Each request is one line {"cmd": name, ...}; the reply is one line with
+    "ok" set, except `watch`, which keeps writing stats lines until the
+    client disconnects.
+    """
+
+    def __init__(self, server, socket_path=SOCKET_PATH):
+        self.server = server
+        self.socket_path = socket_path
+        self.pid_path = pid_path(socket_path)
+        self.unix_server = None
+        self.clients = set()
+        self.started = time.time()
+
+    async def start(self):
+        pid = read_pid(self.socket_path)
+        if pid and pid != os.getpid():
+            raise ControlError(f"NexPing is already running (pid {pid})")
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.unix_server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        with open(self.pid_path, 'w') as f:
+            f.write(f"{os.getpid()}\n")
+        log.info("control socket ready", path=self.socket_path, pid=os.getpid())
+
+    async def close(self):
+        if self.unix_server:
+            self.unix_server.close()
+            for writer in list(self.clients):
+                writer.close()
+            await self.unix_server.wait_closed()
+            self.unix_server = None
+        for path in (self.socket_path, self.pid_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    async def handle_client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    command = request.pop('cmd')
+                    handler = getattr(self, f"cmd_{command}")
+                except (ValueError, KeyError, AttributeError, TypeError):
+                    await self.send(writer, {'ok': False, 'error': 'unknown command'})
+                    continue
+                try:
+                    reply = await handler(writer, **request)
+                except Exception as e:
+                    log.exception("control command failed", command=command)
+                    reply = {'ok': False, 'error': str(e)}
+                if reply is not None:
+                    await self.send(writer, reply)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def send(self, writer, reply):
+        writer.write(json.dumps(reply, default=str).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    def peer_counts(self):
+        network = self.server.network
+        return {'known': len(network.peers), 'online': len(network.presence.online)}
+
+    async def cmd_status(self, writer):
+        network = self.server.network
+        return {
+            'ok': True,
+            'pid': os.getpid(),
+            'name': self.server.server_name,
+            'node_id': self.server.node_id,
+            'uptime': round(time.time() - self.started, 1),
+            'web': f"http://{self.server.host}:{self.server.web_port}",
+            'p2p_port': self.server.p2p_port,
+            'public_address': f"{network.public_ip}:{network.public_port}" if network.public_ip else None,
+            'peers': self.peer_counts(),
+            'transfers': sum(1 for t in network.transfers.transfers()
+                             if t['status'] not in ('complete', 'failed', 'cancelled')),
+            'relays': network.relay_client.info(),
+            'stats': dict(network.stats),
+        }
+
+    async def cmd_contacts(self, writer):
+        contacts = [
+            {
+                'node_id': c['node_id'],
+                'name': c['name'],
+                'online': bool(c['is_online']),
+                'last_seen': c['last_seen'],
+                'address': f"{c['ip_address']}:{c['port']}" if c['ip_address'] else None,
+                'unread_count': c['unread_count'],
+            }
+            for c in await self.server.db.get_contacts()
+            if c['node_id'] != self.server.node_id
+        ]
+        return {'ok': True, 'contacts': contacts}
+
+    async def cmd_watch(self, writer, interval=1.0):
+        """Stream throughput and peer counts every `interval` seconds"""
+        interval = min(max(float(interval), 0.1), 60)
+        stats = self.server.network.stats
+        previous = {key: stats[key] for key in RATE_KEYS}
+        last = time.monotonic()
+        try:
+            while not writer.is_closing():
+                await asyncio.sleep(interval)
+                now = time.monotonic()
+                elapsed = now - last
+                current = {key: stats[key] for key in RATE_KEYS}
+                await self.send(writer, {
+                    'ok': True,
+                    'time': time.time(),
+                    'peers': self.peer_counts(),
+                    'rates': {key: round((current[key] - previous[key]) / elapsed, 1) for key in RATE_KEYS},
+                    'totals': dict(stats),
+                })
+                previous, last = current, now
+        except ConnectionError:
+            # The client went away (e.g. Ctrl-C); nothing to reply to
+            pass
+        return None
+
+    async def cmd_profile(self, writer, seconds=10):
+        from profiler import ProfileSession
+        seconds = float(seconds)
+        if not 0 < seconds <= 300:
+            return {'ok': False, 'error': 'seconds must be between 0 and 300'}
+        summary = await ProfileSession(seconds=seconds).run()
+        return {'ok': True, **summary}
+
+    async def cmd_stop(self, writer):
+        self.server.request_stop()
+        return {'ok': True, 'pid': os.getpid()}
+
+
+class ControlClient:
+    """Blocking client for the control socket; needs only the standard library"""
+
+    def __init__(self, socket_path=SOCKET_PATH, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+
+    def __enter__(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.socket_path)
+        except OSError as e:
+            self.sock.close()
+            raise ControlError("NexPing is not running") from e
+        self.reader = self.sock.makefile('rb')
+        return self
+
+    def __exit__(self, *exc):
+        self.reader.close()
+        self.sock.close()
+
+    def send(self, command, **args):
+        self.sock.sendall(json.dumps({'cmd': command, **args}).encode('utf-8') + b'\n')
+
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            raise ControlError("Connection closed by server")
+        return json.loads(line)
+
+    def request(self, command, **args):
+        """Send one command and return its reply"""
+        self.send(command, **args)
+        reply = self.receive()
+        if not reply.get('ok'):
+            raise ControlError(reply.get('error', 'command failed'))
+        return reply
+
+    def stream(self, command, **args):
+        """Send a streaming command and yield replies until the server closes"""
+        self.send(command, **args)
+        while True:
+            yield self.receive()
\ No newline at end of file
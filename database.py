@@ -2,7 +2,17 @@ import aiosqlite
 import asyncio
 import json
 from datetime import datetime
+import hashlib
 import os
+import uuid
+
+# Characters of the last message kept in the conversation summary
+SNIPPET_LENGTH = 80
+
+def derive_uid(node_id, group_id, timestamp, content):
+    """Message ID for messages that carry none (older peers, history from before msg_uid)"""
+    seed = f"{node_id}|{group_id}|{timestamp}|{content}"
+    return hashlib.sha256(seed.encode('utf-8', errors='ignore')).hexdigest()[:32]
 
 class Database:
     def __init__(self, db_path="nexping.db"):
@@ -12,6 +22,9 @@ class Database:
     async def init_db(self):
         """Initialize database tables"""
         async with aiosqlite.connect(self.db_path) as db:
+            # WAL lets long readers (exports) run without blocking message writes
+            await db.execute('PRAGMA journal_mode=WAL')
+            
             # Contacts table
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS contacts (
@@ -42,6 +55,63 @@ class Database:
                 )
             ''')
             
+            # Group chats; messages of a group are stored once with messages.group_id set
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS chat_groups (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    group_id TEXT UNIQUE NOT NULL,
+                    name TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS group_members (
+                    group_id INTEGER NOT NULL,
+                    contact_id INTEGER NOT NULL,
+                    PRIMARY KEY (group_id, contact_id),
+                    FOREIGN KEY (group_id) REFERENCES chat_groups (id),
+                    FOREIGN KEY (contact_id) REFERENCES contacts (id)
+                )
+            ''')
+            
+            await self._add_column(db, 'messages', 'group_id', 'INTEGER REFERENCES chat_groups (id)')
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_group ON messages (group_id)
+            ''')
+            await self._add_column(db, 'messages', 'is_outgoing', 'BOOLEAN DEFAULT FALSE')
+            # Network-wide message ID; the unique index makes storing a message idempotent
+            await self._add_column(db, 'messages', 'msg_uid', 'TEXT')
+            await db.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_uid ON messages (msg_uid)
+            ''')
+            await self._backfill_uids(db)
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_contact ON messages (contact_id, is_read)
+            ''')
+            
+            # Per-conversation summary kept up to date by add_message, so the
+            # contact list never has to scan messages
+            cursor = await db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversations'"
+            )
+            has_conversations = await cursor.fetchone()
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    contact_id INTEGER UNIQUE,
+                    group_id INTEGER UNIQUE,
+                    last_message_id INTEGER,
+                    last_snippet TEXT,
+                    last_timestamp TIMESTAMP,
+                    unread_count INTEGER NOT NULL DEFAULT 0,
+                    FOREIGN KEY (contact_id) REFERENCES contacts (id),
+                    FOREIGN KEY (group_id) REFERENCES chat_groups (id)
+                )
+            ''')
+            if not has_conversations:
+                await self._rebuild_conversations(db)
+            
             # Server settings table
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS settings (
@@ -53,13 +123,75 @@ class Database:
             await db.commit()
             self.init_done = True
 
+    async def _add_column(self, db, table, column, definition):
+        """Add a column to an existing table (databases created by older versions)"""
+        cursor = await db.execute(f'PRAGMA table_info({table})')
+        columns = [row[1] for row in await cursor.fetchall()]
+        if column not in columns:
+            await db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    async def _backfill_uids(self, db):
+        """Give messages stored before msg_uid existed a stable ID, so re-imports skip them"""
+        cursor = await db.execute('SELECT 1 FROM messages WHERE msg_uid IS NULL LIMIT 1')
+        if not await cursor.fetchone():
+            return
+        await db.create_function('nexping_uid', 4, derive_uid, deterministic=True)
+        await db.execute('''
+            UPDATE OR IGNORE messages SET msg_uid = nexping_uid(
+                (SELECT node_id FROM contacts WHERE contacts.id = messages.contact_id),
+                (SELECT group_id FROM chat_groups WHERE chat_groups.id = messages.group_id),
+                timestamp, content)
+            WHERE msg_uid IS NULL
+        ''')
+        # Identical messages within the same second collide; the row id tells them apart
+        await db.execute('''
+            UPDATE messages SET msg_uid = nexping_uid(id, group_id, timestamp, content)
+            WHERE msg_uid IS NULL
+        ''')
+
+    async def _rebuild_conversations(self, db):
+        """Recompute every conversation summary from the messages table"""
+        await db.execute('DELETE FROM conversations')
+        await db.execute(f'''
+            INSERT INTO conversations
+            (contact_id, group_id, last_message_id, last_snippet, last_timestamp, unread_count)
+            SELECT m.contact_id, NULL, m.id,
+                   CASE WHEN m.message_type = 'file' THEN '[file]' ELSE substr(m.content, 1, {SNIPPET_LENGTH}) END,
+                   m.timestamp,
+                   (SELECT COUNT(*) FROM messages u
+                    WHERE u.contact_id = m.contact_id AND u.group_id IS NULL
+                    AND u.is_read = 0 AND u.is_outgoing = 0)
+            FROM messages m
+            WHERE m.id IN (SELECT MAX(id) FROM messages
+                           WHERE group_id IS NULL AND contact_id IS NOT NULL
+                           GROUP BY contact_id)
+        ''')
+        await db.execute(f'''
+            INSERT INTO conversations
+            (contact_id, group_id, last_message_id, last_snippet, last_timestamp, unread_count)
+            SELECT NULL, m.group_id, m.id,
+                   CASE WHEN m.message_type = 'file' THEN '[file]' ELSE substr(m.content, 1, {SNIPPET_LENGTH}) END,
+                   m.timestamp,
+                   (SELECT COUNT(*) FROM messages u
+                    WHERE u.group_id = m.group_id AND u.is_read = 0 AND u.is_outgoing = 0)
+            FROM messages m
+            WHERE m.id IN (SELECT MAX(id) FROM messages WHERE group_id IS NOT NULL GROUP BY group_id)
+        ''')
+
     async def add_contact(self, node_id, name, ip_address=None, port=None, public_key=None):
-        """Add or update a contact"""
+        """Add or update a contact, keeping its row id stable"""
         async with aiosqlite.connect(self.db_path) as db:
             await db.execute('''
-                INSERT OR REPLACE INTO contacts 
+                INSERT INTO contacts 
                 (node_id, name, ip_address, port, public_key, last_seen, is_online)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (node_id) DO UPDATE SET
+                    name = excluded.name,
+                    ip_address = COALESCE(excluded.ip_address, contacts.ip_address),
+                    port = COALESCE(excluded.port, contacts.port),
+                    public_key = COALESCE(excluded.public_key, contacts.public_key),
+                    last_seen = excluded.last_seen,
+                    is_online = excluded.is_online
             ''', (node_id, name, ip_address, port, public_key, datetime.now(), True))
             await db.commit()
 
@@ -68,30 +200,108 @@ class Database:
         async with aiosqlite.connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute('''
-                SELECT * FROM contacts ORDER BY is_online DESC, name ASC
+                SELECT c.*, cv.last_message_id, cv.last_snippet, cv.last_timestamp,
+                       COALESCE(cv.unread_count, 0) as unread_count
+                FROM contacts c
+                LEFT JOIN conversations cv ON cv.contact_id = c.id
+                ORDER BY c.is_online DESC, c.name ASC
             ''')
             contacts = await cursor.fetchall()
             return [dict(contact) for contact in contacts]
 
-    async def update_contact_status(self, node_id, is_online):
-        """Update contact online status"""
+    async def update_contact_status(self, node_id, is_online, last_seen=None):
+        """Update contact online status; last_seen is kept if not given"""
         async with aiosqlite.connect(self.db_path) as db:
             await db.execute('''
                 UPDATE contacts 
-                SET is_online = ?, last_seen = ?
+                SET is_online = ?, last_seen = COALESCE(?, last_seen)
                 WHERE node_id = ?
-            ''', (is_online, datetime.now(), node_id))
+            ''', (is_online, last_seen, node_id))
             await db.commit()
 
-    async def add_message(self, contact_id, content, message_type="text", encrypted_content=None):
-        """Add a new message"""
+    async def touch_contacts(self, seen):
+        """Batch-update last_seen from (node_id, timestamp) pairs"""
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.executemany('''
+                UPDATE contacts SET last_seen = ? WHERE node_id = ?
+            ''', [(timestamp, node_id) for node_id, timestamp in seen])
+            await db.commit()
+
+    async def reset_presence(self):
+        """Mark every contact offline; presence is rebuilt from live traffic"""
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute('UPDATE contacts SET is_online = FALSE WHERE is_online')
+            await db.commit()
+
+    async def add_message(self, contact_id, content, message_type="text", encrypted_content=None,
+                          group_id=None, is_outgoing=False, msg_uid=None):
+        """Add a new message and update its conversation summary.
+
+        Returns the new row id, or None if a message with the same msg_uid
+        is already stored.
+        """
+        # Every row gets an ID, so an export of it can be imported again without duplicating
+        msg_uid = msg_uid or uuid.uuid4().hex
         async with aiosqlite.connect(self.db_path) as db:
             cursor = await db.execute('''
-                INSERT INTO messages (contact_id, message_type, content, encrypted_content)
-                VALUES (?, ?, ?, ?)
-            ''', (contact_id, message_type, content, encrypted_content))
+                INSERT INTO messages
+                (contact_id, message_type, content, encrypted_content, group_id, is_outgoing, msg_uid)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (msg_uid) DO NOTHING
+            ''', (contact_id, message_type, content, encrypted_content, group_id, is_outgoing, msg_uid))
+            if cursor.rowcount == 0:
+                return None
+            message_id = cursor.lastrowid
+            
+            key_column = 'group_id' if group_id is not None else 'contact_id'
+            if group_id is not None or contact_id is not None:
+                await db.execute(f'''
+                    INSERT INTO conversations
+                    (contact_id, group_id, last_message_id, last_snippet, last_timestamp, unread_count)
+                    VALUES (?, ?, ?, ?, (SELECT timestamp FROM messages WHERE id = ?), ?)
+                    ON CONFLICT({key_column}) DO UPDATE SET
+                        last_message_id = excluded.last_message_id,
+                        last_snippet = excluded.last_snippet,
+                        last_timestamp = excluded.last_timestamp,
+                        unread_count = unread_count + excluded.unread_count
+                ''', (
+                    None if group_id is not None else contact_id, group_id, message_id,
+                    '[file]' if message_type == 'file' else content[:SNIPPET_LENGTH],
+                    message_id, 0 if is_outgoing else 1
+                ))
+            await db.commit()
+            return message_id
+
+    async def mark_read(self, contact_id=None, group_id=None, up_to_id=None):
+        """Mark incoming messages of a conversation as read; returns how many changed"""
+        if group_id is not None:
+            where, key = 'group_id = ?', group_id
+        else:
+            where, key = 'contact_id = ? AND group_id IS NULL', contact_id
+        params = [key]
+        if up_to_id is not None:
+            where += ' AND id <= ?'
+            params.append(up_to_id)
+        
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute(f'''
+                UPDATE messages SET is_read = 1
+                WHERE {where} AND is_read = 0 AND is_outgoing = 0
+            ''', params)
+            updated = cursor.rowcount
+            
+            conversation_key = 'group_id' if group_id is not None else 'contact_id'
+            if up_to_id is None:
+                await db.execute(f'''
+                    UPDATE conversations SET unread_count = 0 WHERE {conversation_key} = ?
+                ''', (key,))
+            elif updated:
+                await db.execute(f'''
+                    UPDATE conversations SET unread_count = MAX(0, unread_count - ?)
+                    WHERE {conversation_key} = ?
+                ''', (updated, key))
             await db.commit()
-            return cursor.lastrowid
+            return updated
 
     async def get_messages(self, contact_id, limit=100):
         """Get messages for a contact"""
@@ -101,7 +311,7 @@ class Database:
                 SELECT m.*, c.name as contact_name 
                 FROM messages m 
                 JOIN contacts c ON m.contact_id = c.id 
-                WHERE m.contact_id = ? 
+                WHERE m.contact_id = ? AND m.group_id IS NULL 
                 ORDER BY m.timestamp ASC 
                 LIMIT ?
             ''', (contact_id, limit))
@@ -116,6 +326,208 @@ class Database:
             contact = await cursor.fetchone()
             return dict(contact) if contact else None
 
+    async def create_group(self, group_id, name, member_node_ids):
+        """Create a group (or extend an existing one) with members given by node ID.
+
+        Members we have no contact for yet get an offline placeholder contact.
+        """
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute('''
+                INSERT OR IGNORE INTO chat_groups (group_id, name) VALUES (?, ?)
+            ''', (group_id, name))
+            await db.executemany('''
+                INSERT OR IGNORE INTO contacts (node_id, name, is_online) VALUES (?, ?, FALSE)
+            ''', [(node_id, f"Node_{node_id[:8]}") for node_id in member_node_ids])
+            cursor = await db.execute('SELECT id FROM chat_groups WHERE group_id = ?', (group_id,))
+            group_pk = (await cursor.fetchone())[0]
+            await db.executemany('''
+                INSERT OR IGNORE INTO group_members (group_id, contact_id)
+                SELECT ?, id FROM contacts WHERE node_id = ?
+            ''', [(group_pk, node_id) for node_id in member_node_ids])
+            await db.commit()
+            return group_pk
+
+    async def get_group(self, group_id):
+        """Get group by its network-wide ID, including member node IDs"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            cursor = await db.execute('SELECT * FROM chat_groups WHERE group_id = ?', (group_id,))
+            group = await cursor.fetchone()
+            if not group:
+                return None
+            group = dict(group)
+            cursor = await db.execute('''
+                SELECT c.node_id FROM group_members gm
+                JOIN contacts c ON gm.contact_id = c.id
+                WHERE gm.group_id = ?
+            ''', (group['id'],))
+            group['members'] = [row[0] for row in await cursor.fetchall()]
+            return group
+
+    async def get_groups(self):
+        """Get all groups with member node IDs"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            cursor = await db.execute('''
+                SELECT g.*, GROUP_CONCAT(c.node_id) as member_ids,
+                       cv.last_message_id, cv.last_snippet, cv.last_timestamp,
+                       COALESCE(cv.unread_count, 0) as unread_count
+                FROM chat_groups g
+                LEFT JOIN group_members gm ON gm.group_id = g.id
+                LEFT JOIN contacts c ON gm.contact_id = c.id
+                LEFT JOIN conversations cv ON cv.group_id = g.id
+                GROUP BY g.id
+                ORDER BY g.name ASC
+            ''')
+            groups = []
+            for row in await cursor.fetchall():
+                group = dict(row)
+                member_ids = group.pop('member_ids')
+                group['members'] = member_ids.split(',') if member_ids else []
+                groups.append(group)
+            return groups
+
+    async def get_group_messages(self, group_id, limit=100):
+        """Get messages for a group"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            cursor = await db.execute('''
+                SELECT m.*, c.name as contact_name 
+                FROM messages m 
+                LEFT JOIN contacts c ON m.contact_id = c.id 
+                WHERE m.group_id = ? 
+                ORDER BY m.timestamp ASC 
+                LIMIT ?
+            ''', (group_id, limit))
+            messages = await cursor.fetchall()
+            return [dict(message) for message in messages]
+
+    # Export order matters: rows may only reference tables exported before them
+    EXPORT_QUERIES = [
+        ('settings', 'SELECT key, value FROM settings ORDER BY key'),
+        ('contacts', '''
+            SELECT node_id, name, ip_address, port, public_key, last_seen, is_online, created_at
+            FROM contacts ORDER BY id
+        '''),
+        ('chat_groups', 'SELECT group_id, name, created_at FROM chat_groups ORDER BY id'),
+        ('group_members', '''
+            SELECT g.group_id, c.node_id
+            FROM group_members gm
+            JOIN chat_groups g ON gm.group_id = g.id
+            JOIN contacts c ON gm.contact_id = c.id
+            ORDER BY gm.group_id, gm.contact_id
+        '''),
+        ('messages', '''
+            SELECT c.node_id, g.group_id, m.message_type, m.content, m.encrypted_content,
+                   m.timestamp, m.is_delivered, m.is_read, m.is_outgoing, m.msg_uid
+            FROM messages m
+            LEFT JOIN contacts c ON m.contact_id = c.id
+            LEFT JOIN chat_groups g ON m.group_id = g.id
+            ORDER BY m.id
+        '''),
+    ]
+
+    async def export_rows(self, batch_size=1000):
+        """Yield (table, row) for every row, reading in batches from one consistent snapshot.
+
+        Foreign keys are exported as node IDs / group IDs so the rows can be
+        imported into a database with different row ids.
+        """
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            await db.execute('BEGIN')
+            try:
+                for table, query in self.EXPORT_QUERIES:
+                    async with db.execute(query) as cursor:
+                        while True:
+                            rows = await cursor.fetchmany(batch_size)
+                            if not rows:
+                                break
+                            for row in rows:
+                                yield table, dict(row)
+            finally:
+                await db.rollback()
+
+    async def import_rows(self, records, batch_size=1000):
+        """Import (table, row) pairs from export_rows, committing every batch_size rows.
+
+        Existing contacts and groups are kept; references are resolved to
+        this database's row ids. Returns the number of rows read per table.
+        """
+        counts = {}
+        contact_ids = {}
+        group_ids = {}
+        pending = []
+        pending_table = None
+
+        async with aiosqlite.connect(self.db_path) as db:
+
+            async def flush():
+                if not pending:
+                    return
+                if pending_table == 'settings':
+                    await db.executemany('''
+                        INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
+                    ''', [(r['key'], r['value']) for r in pending])
+                elif pending_table == 'contacts':
+                    await db.executemany('''
+                        INSERT OR IGNORE INTO contacts
+                        (node_id, name, ip_address, port, public_key, last_seen, is_online, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', [(r['node_id'], r['name'], r.get('ip_address'), r.get('port'),
+                           r.get('public_key'), r.get('last_seen'), False, r.get('created_at'))
+                          for r in pending])
+                elif pending_table == 'chat_groups':
+                    await db.executemany('''
+                        INSERT OR IGNORE INTO chat_groups (group_id, name, created_at) VALUES (?, ?, ?)
+                    ''', [(r['group_id'], r['name'], r.get('created_at')) for r in pending])
+                elif pending_table == 'group_members':
+                    await db.executemany('''
+                        INSERT OR IGNORE INTO group_members (group_id, contact_id) VALUES (?, ?)
+                    ''', [(group_ids[r['group_id']], contact_ids[r['node_id']]) for r in pending
+                          if r['group_id'] in group_ids and r['node_id'] in contact_ids])
+                elif pending_table == 'messages':
+                    await db.executemany('''
+                        INSERT INTO messages
+                        (contact_id, group_id, message_type, content, encrypted_content,
+                         timestamp, is_delivered, is_read, is_outgoing, msg_uid)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (msg_uid) DO NOTHING
+                    ''', [(contact_ids.get(r.get('node_id')), group_ids.get(r.get('group_id')),
+                           r['message_type'], r['content'], r.get('encrypted_content'),
+                           r.get('timestamp'), r.get('is_delivered', False), r.get('is_read', False),
+                           r.get('is_outgoing', False),
+                           r.get('msg_uid') or derive_uid(r.get('node_id'), r.get('group_id'),
+                                                          r.get('timestamp'), r['content']))
+                          for r in pending])
+                await db.commit()
+                pending.clear()
+
+            async for table, row in records:
+                if table not in ('settings', 'contacts', 'chat_groups', 'group_members', 'messages'):
+                    continue
+                if table != pending_table or len(pending) >= batch_size:
+                    await flush()
+                    if table != pending_table and table in ('group_members', 'messages'):
+                        # Contacts and groups precede these in an export, so the id maps are complete
+                        cursor = await db.execute('SELECT node_id, id FROM contacts')
+                        contact_ids = dict(await cursor.fetchall())
+                        cursor = await db.execute('SELECT group_id, id FROM chat_groups')
+                        group_ids = dict(await cursor.fetchall())
+                    pending_table = table
+                pending.append(row)
+                counts[table] = counts.get(table, 0) + 1
+            await flush()
+            if counts.get('messages'):
+                await self._rebuild_conversations(db)
+                await db.commit()
+        return counts
+
+    async def checkpoint(self):
+        """Fold the WAL back into the main database file"""
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
     async def save_setting(self, key, value):
         """Save server setting"""
         async with aiosqlite.connect(self.db_path) as db:
@@ -0,0 +1,664 @@
+import asyncio
+import base64
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import time
+import uuid
+from collections import deque
+
+from logger import get_logger
+from transport import RECV_BUFFER
+
+log = get_logger('files')
+
+# Binary frames share the UDP port with the JSON protocol; JSON always starts with '{'
+CHUNK_MAGIC = b'NXC1'
+ACK_MAGIC = b'NXA1'
+# magic, transfer id, chunk index, blake2b-128 of the payload
+CHUNK_HEADER = struct.Struct('>4s16sI16s')
+ACK_FRAME = struct.Struct('>4s16sI')
+
+CHUNK_SIZE = 1200            # payload bytes; header + payload stays under a 1280-byte MTU
+MAX_FILE_SIZE = 4 * 1024 ** 3
+# Limits on what a peer's file_offer may ask us to allocate
+MAX_CHUNK_SIZE = RECV_BUFFER - CHUNK_HEADER.size
+MAX_CHUNKS = -(-MAX_FILE_SIZE // CHUNK_SIZE)
+MAX_RECEIVERS = 8
+INITIAL_WINDOW = 4
+MAX_WINDOW = 512
+MIN_RTO = 0.2
+MAX_RTO = 5.0
+STALL_TIMEOUT = 30
+CONTROL_RETRIES = 5
+STATE_FLUSH_INTERVAL = 2.0
+
+TRANSFER_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class TransferError(Exception):
+    pass
+
+
+def chunk_digest(payload):
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def safe_filename(name):
+    """Strip directories and unsafe characters from a peer-supplied file name"""
+    name = os.path.basename(str(name or '').replace('\\', '/')).strip()
+    name = re.sub(r'[^\w.\- ]', '_', name).lstrip('.')
+    return name[:200] or 'file'
+
+
+def offer_msg_id(offer):
+    """Chat message ID the sender stored this send under; None from senders without one"""
+    msg_id = offer.get('msg_id')
+    return str(msg_id)[:64] if msg_id else None
+
+
+def file_sha256(path):
+    """SHA-256 of a file through mmap, so the file is never read into memory"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+    return digest.hexdigest()
+
+
+def bitmap_ranges(bitmap, count):
+    """Encode the set bits of a chunk bitmap as [start, end) ranges"""
+    ranges = []
+    start = None
+    for byte_index, byte in enumerate(bitmap):
+        # Whole bytes that continue the current run need no bit checks
+        if (byte == 0xFF and start is not None) or (byte == 0 and start is None):
+            continue
+        for bit in range(8):
+            index = (byte_index << 3) + bit
+            if index >= count:
+                break
+            have = byte & (1 << bit)
+            if have and start is None:
+                start = index
+            elif not have and start is not None:
+                ranges.append([start, index])
+                start = None
+    if start is not None:
+        ranges.append([start, count])
+    return ranges
+
+
+class FileSender:
+    """Sends one file with a sliding window and AIMD congestion control.
+
+    Chunks are memoryview slices of an mmap of the file and go out with
+    sendmsg() next to their header, so payload bytes are never copied in Python.
+    """
+
+    def __init__(self, manager, peer_id, addr, path, name, chunk_size=CHUNK_SIZE):
+        self.manager = manager
+        self.network = manager.network
+        self.peer_id = peer_id
+        self.addr = addr
+        self.path = path
+        self.name = name
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.chunk_count = (self.size + chunk_size - 1) // chunk_size
+        self.sha256 = None
+        self.transfer_id = None
+        # transfer_id repeats for a re-send of the same file (that is what
+        # resumes it); the chat message of each send gets its own ID
+        self.msg_id = uuid.uuid4().hex
+        self.status = 'hashing'
+        self.acked = set()
+        self.inflight = {}
+        self.retransmits = 0
+        self.cwnd = float(INITIAL_WINDOW)
+        self.ssthresh = float(MAX_WINDOW)
+        self.srtt = None
+        self.rttvar = None
+        self.rto = 1.0
+        self.started = None
+        self.finished = None
+        self.accepted = None
+        self.completed = None
+        self.ack_event = asyncio.Event()
+
+    async def prepare(self):
+        """Hash the file and derive the transfer id (same file + peers = same id, which enables resume)"""
+        loop = asyncio.get_running_loop()
+        self.sha256 = await loop.run_in_executor(None, file_sha256, self.path)
+        seed = f"{self.sha256}:{self.network.node_id}:{self.peer_id}".encode()
+        self.transfer_id = hashlib.blake2b(seed, digest_size=16).hexdigest()
+        self.status = 'offered'
+        return self.transfer_id
+
+    def info(self):
+        elapsed = (self.finished or time.monotonic()) - self.started if self.started else 0
+        sent_bytes = min(len(self.acked) * self.chunk_size, self.size)
+        return {
+            'transfer_id': self.transfer_id,
+            'direction': 'send',
+            'peer': self.peer_id,
+            'name': self.name,
+            'size': self.size,
+            'status': self.status,
+            'chunks': self.chunk_count,
+            'done_chunks': len(self.acked),
+            'retransmits': self.retransmits,
+            'window': int(self.cwnd),
+            'rate_bytes_per_s': int(sent_bytes / elapsed) if elapsed else 0,
+        }
+
+    def control(self, msg_type, **fields):
+        message = {
+            'type': msg_type,
+            'from': self.network.node_id,
+            'transfer_id': self.transfer_id,
+            'timestamp': self.network.clock().isoformat()
+        }
+        message.update(fields)
+        return message
+
+    async def request(self, message, future_attr):
+        """Send a control message until the peer answers it"""
+        loop = asyncio.get_running_loop()
+        for _ in range(CONTROL_RETRIES):
+            future = loop.create_future()
+            setattr(self, future_attr, future)
+            await self.network.send_to_address(message, self.addr)
+            try:
+                return await asyncio.wait_for(future, timeout=2)
+            except asyncio.TimeoutError:
+                continue
+        raise TransferError(f"No answer to {message['type']} from {self.peer_id}")
+
+    async def run(self):
+        try:
+            offer = self.control(
+                'file_offer', name=self.name, size=self.size, chunk_size=self.chunk_size,
+                chunks=self.chunk_count, sha256=self.sha256, msg_id=self.msg_id
+            )
+            accept = await self.request(offer, 'accepted')
+            if not accept.get('ok', True):
+                raise TransferError(accept.get('error', 'offer rejected'))
+            for start, end in accept.get('have', []):
+                self.acked.update(range(max(0, start), min(end, self.chunk_count)))
+
+            self.status = 'sending'
+            self.started = time.monotonic()
+            if self.chunk_count > len(self.acked):
+                with open(self.path, 'rb') as f:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        view = memoryview(mm)
+                        try:
+                            await self.send_chunks(view)
+                        finally:
+                            view.release()
+
+            self.status = 'verifying'
+            result = await self.request(self.control('file_done'), 'completed')
+            if not result.get('ok'):
+                raise TransferError(result.get('error', 'receiver rejected the file'))
+            self.status = 'complete'
+            log.info("file sent", transfer=self.transfer_id, peer=self.peer_id,
+                     size=self.size, retransmits=self.retransmits)
+        except TransferError as e:
+            self.status = 'failed'
+            log.warning("file send failed", transfer=self.transfer_id, peer=self.peer_id, error=e)
+        except asyncio.CancelledError:
+            self.status = 'cancelled'
+            raise
+        finally:
+            self.finished = time.monotonic()
+
+    async def send_chunks(self, view):
+        loop = asyncio.get_running_loop()
+        transport = self.network.transport
+        tid = bytes.fromhex(self.transfer_id)
+        fresh = (i for i in range(self.chunk_count) if i not in self.acked)
+        retransmit = deque()
+        last_progress = loop.time()
+        last_reduction = 0.0
+        exhausted = False
+
+        while True:
+            now = loop.time()
+            lost = False
+            for index, (sent_at, _) in list(self.inflight.items()):
+                if now - sent_at > self.rto:
+                    del self.inflight[index]
+                    retransmit.append(index)
+                    lost = True
+            if lost and now - last_reduction > (self.srtt or self.rto):
+                # Multiplicative decrease at most once per round trip
+                self.ssthresh = max(self.cwnd / 2, 2.0)
+                self.cwnd = self.ssthresh
+                self.rto = min(self.rto * 2, MAX_RTO)
+                last_reduction = now
+
+            while len(self.inflight) < int(self.cwnd):
+                if retransmit:
+                    index = retransmit.popleft()
+                    if index in self.acked:
+                        continue
+                    is_retransmit = True
+                elif not exhausted:
+                    index = next(fresh, None)
+                    if index is None:
+                        exhausted = True
+                        continue
+                    is_retransmit = False
+                else:
+                    break
+                start = index * self.chunk_size
+                payload = view[start:start + self.chunk_size]
+                header = CHUNK_HEADER.pack(CHUNK_MAGIC, tid, index, chunk_digest(payload))
+                try:
+                    transport.sendmsg([header, payload], self.addr)
+                except BlockingIOError:
+                    # Socket buffer full: treat like loss and let acks drain it
+                    retransmit.appendleft(index)
+                    break
+                except OSError as e:
+                    raise TransferError(f"send failed: {e}")
+                finally:
+                    payload.release()
+                if is_retransmit:
+                    self.retransmits += 1
+                self.inflight[index] = (loop.time(), is_retransmit)
+
+            if len(self.acked) >= self.chunk_count:
+                return
+
+            acked_before = len(self.acked)
+            self.ack_event.clear()
+            try:
+                await asyncio.wait_for(self.ack_event.wait(), timeout=self.rto)
+            except asyncio.TimeoutError:
+                pass
+            if len(self.acked) > acked_before:
+                last_progress = loop.time()
+            elif loop.time() - last_progress > STALL_TIMEOUT:
+                raise TransferError("transfer stalled")
+
+    def on_ack(self, index):
+        entry = self.inflight.pop(index, None)
+        if index in self.acked:
+            return
+        self.acked.add(index)
+        if entry:
+            sent_at, was_retransmit = entry
+            if not was_retransmit:
+                # Karn's rule: only time chunks that were sent once
+                self.update_rtt(asyncio.get_running_loop().time() - sent_at)
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+        else:
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_WINDOW)
+        self.ack_event.set()
+
+    def update_rtt(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+
+class FileReceiver:
+    """Writes incoming chunks straight into a sparse .part file and tracks them in a bitmap"""
+
+    def __init__(self, manager, offer, addr):
+        self.manager = manager
+        self.network = manager.network
+        self.transfer_id = offer['transfer_id']
+        self.peer_id = offer['from']
+        self.addr = addr
+        self.name = safe_filename(offer.get('name'))
+        self.size = int(offer['size'])
+        self.chunk_size = int(offer['chunk_size'])
+        self.chunk_count = int(offer['chunks'])
+        self.sha256 = offer['sha256']
+        self.msg_id = offer_msg_id(offer)
+        if not 0 < self.size <= MAX_FILE_SIZE:
+            raise TransferError('invalid file size')
+        if not 0 < self.chunk_size <= MAX_CHUNK_SIZE:
+            raise TransferError('invalid chunk size')
+        if self.chunk_count != -(-self.size // self.chunk_size) or self.chunk_count > MAX_CHUNKS:
+            raise TransferError('invalid chunk count')
+        if not re.match(r'^[0-9a-f]{64}$', str(self.sha256)):
+            raise TransferError('invalid sha256')
+        self.status = 'receiving'
+        self.part_path = os.path.join(manager.downloads_dir, f"{self.transfer_id}.part")
+        self.state_path = self.part_path + '.state'
+        self.bitmap = bytearray((self.chunk_count + 7) // 8)
+        self.received = 0
+        self.started = time.monotonic()
+        self.last_activity = self.started
+        self.finished = None
+        self.dirty = False
+        self.last_flush = 0.0
+        self.fd = None
+
+    def open(self):
+        """Open (or resume) the .part file; returns the chunk ranges already on disk"""
+        os.makedirs(self.manager.downloads_dir, exist_ok=True)
+        state = self.load_state()
+        if state is None and os.path.exists(self.part_path):
+            os.remove(self.part_path)
+        self.fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, self.size)
+        if state:
+            self.bitmap[:] = base64.b64decode(state['bitmap'])
+            self.received = sum(bin(byte).count('1') for byte in self.bitmap)
+        return bitmap_ranges(self.bitmap, self.chunk_count)
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (state.get('sha256'), state.get('size'), state.get('chunk_size')) != \
+                (self.sha256, self.size, self.chunk_size):
+            return None
+        try:
+            if len(base64.b64decode(state.get('bitmap', ''))) != len(self.bitmap):
+                return None
+        except ValueError:
+            return None
+        return state
+
+    def save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'transfer_id': self.transfer_id,
+                'from': self.peer_id,
+                'name': self.name,
+                'size': self.size,
+                'chunk_size': self.chunk_size,
+                'sha256': self.sha256,
+                'bitmap': base64.b64encode(self.bitmap).decode('ascii'),
+            }, f)
+        os.replace(tmp_path, self.state_path)
+        self.dirty = False
+        self.last_flush = time.monotonic()
+
+    def info(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return {
+            'transfer_id': self.transfer_id,
+            'direction': 'receive',
+            'peer': self.peer_id,
+            'name': self.name,
+            'size': self.size,
+            'status': self.status,
+            'chunks': self.chunk_count,
+            'done_chunks': self.received,
+            'rate_bytes_per_s': int(min(self.received * self.chunk_size, self.size) / elapsed) if elapsed else 0,
+        }
+
+    def write_chunk(self, index, digest, payload):
+        """Verify and store one chunk; returns True if it should be acknowledged"""
+        if index >= self.chunk_count or self.fd is None:
+            return False
+        expected = min(self.chunk_size, self.size - index * self.chunk_size)
+        if len(payload) != expected or chunk_digest(payload) != digest:
+            return False
+        self.last_activity = time.monotonic()
+        mask = 1 << (index & 7)
+        if not self.bitmap[index >> 3] & mask:
+            os.pwrite(self.fd, payload, index * self.chunk_size)
+            self.bitmap[index >> 3] |= mask
+            self.received += 1
+            self.dirty = True
+            if time.monotonic() - self.last_flush > STATE_FLUSH_INTERVAL:
+                self.save_state()
+        return True
+
+    async def finish(self):
+        """Verify the whole file and move it into place; returns (ok, error)"""
+        if self.received < self.chunk_count:
+            return False, 'missing chunks'
+        self.close()
+        loop = asyncio.get_running_loop()
+        self.status = 'verifying'
+        digest = await loop.run_in_executor(None, file_sha256, self.part_path)
+        if digest != self.sha256:
+            self.status = 'failed'
+            os.remove(self.part_path)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            return False, 'checksum mismatch'
+        target_dir = os.path.join(self.manager.downloads_dir, self.transfer_id)
+        os.makedirs(target_dir, exist_ok=True)
+        os.replace(self.part_path, os.path.join(target_dir, self.name))
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        self.status = 'complete'
+        self.finished = time.monotonic()
+        return True, None
+
+    def close(self):
+        if self.fd is not None:
+            if self.dirty:
+                self.save_state()
+            os.close(self.fd)
+            self.fd = None
+
+
+class FileTransferManager:
+    """Owns the file transfers of one P2PNetwork"""
+
+    def __init__(self, network, downloads_dir='received', uploads_dir='uploads', chunk_size=CHUNK_SIZE):
+        self.network = network
+        self.downloads_dir = downloads_dir
+        self.uploads_dir = uploads_dir
+        self.chunk_size = chunk_size
+        self.senders = {}
+        self.receivers = {}
+        self.tasks = set()
+
+    def transfers(self):
+        return [t.info() for t in list(self.senders.values()) + list(self.receivers.values())]
+
+    def file_path(self, transfer_id):
+        """Path of a completed received or sent file, or None"""
+        if not TRANSFER_ID_RE.match(transfer_id or ''):
+            return None
+        for base in (self.downloads_dir, self.uploads_dir):
+            directory = os.path.join(base, transfer_id)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    return os.path.join(directory, name)
+        return None
+
+    async def send_file(self, peer_id, path, name=None, keep_copy=False):
+        """Start sending a file to a peer; returns the transfer id.
+
+        With keep_copy the file is moved to uploads/<transfer_id>/ so it can
+        be downloaded again later.
+        """
+        addr = self.network.peer_address(peer_id)
+        if not addr:
+            raise TransferError(f"Peer {peer_id} has no direct address")
+        size = os.path.getsize(path)
+        if size > MAX_FILE_SIZE:
+            raise TransferError("File too large")
+
+        sender = FileSender(self, peer_id, addr, path, safe_filename(name or path), self.chunk_size)
+        transfer_id = await sender.prepare()
+        if transfer_id in self.senders and self.senders[transfer_id].status in ('offered', 'sending', 'verifying'):
+            return transfer_id
+        self.senders[transfer_id] = sender
+
+        if keep_copy:
+            target_dir = os.path.join(self.uploads_dir, transfer_id)
+            os.makedirs(target_dir, exist_ok=True)
+            sender.path = os.path.join(target_dir, sender.name)
+            os.replace(path, sender.path)
+
+        contact = await self.network.db.get_contact_by_node_id(peer_id)
+        if contact:
+            await self.network.db.add_message(
+                contact_id=contact['id'],
+                content=json.dumps({'name': sender.name, 'size': size,
+                                    'sha256': sender.sha256, 'transfer_id': transfer_id}),
+                message_type='file',
+                is_outgoing=True,
+                msg_uid=sender.msg_id
+            )
+
+        task = asyncio.create_task(sender.run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return transfer_id
+
+    async def store_upload(self, stream):
+        """Stream an upload body to a temporary file without buffering it in memory"""
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        tmp_path = os.path.join(self.uploads_dir, f".upload-{os.urandom(8).hex()}")
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                async for chunk in stream.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > MAX_FILE_SIZE:
+                        raise TransferError("File too large")
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def open_receivers(self):
+        """Count receivers holding an open .part file, closing stalled ones (they can resume)"""
+        now = time.monotonic()
+        count = 0
+        for receiver in self.receivers.values():
+            if receiver.fd is not None and now - receiver.last_activity > STALL_TIMEOUT:
+                receiver.close()
+            if receiver.fd is not None:
+                count += 1
+        return count
+
+    def handle_frame(self, data, addr):
+        """Handle a binary chunk or ack datagram"""
+        view = memoryview(data)
+        magic = bytes(view[:4])
+        if magic == CHUNK_MAGIC and len(view) >= CHUNK_HEADER.size:
+            _, tid, index, digest = CHUNK_HEADER.unpack_from(view)
+            receiver = self.receivers.get(tid.hex())
+            # Only the peer that made the offer may fill in its chunks
+            if receiver and receiver.addr == addr and receiver.write_chunk(index, digest, view[CHUNK_HEADER.size:]):
+                try:
+                    self.network.transport.sendto(ACK_FRAME.pack(ACK_MAGIC, tid, index), addr)
+                except OSError:
+                    pass
+        elif magic == ACK_MAGIC and len(view) >= ACK_FRAME.size:
+            _, tid, index = ACK_FRAME.unpack_from(view)
+            sender = self.senders.get(tid.hex())
+            if sender:
+                sender.on_ack(index)
+
+    async def handle_offer(self, message, addr):
+        transfer_id = message.get('transfer_id', '')
+        reply = {
+            'type': 'file_accept',
+            'from': self.network.node_id,
+            'transfer_id': transfer_id,
+            'timestamp': self.network.clock().isoformat()
+        }
+        try:
+            if not TRANSFER_ID_RE.match(transfer_id):
+                raise TransferError('invalid transfer id')
+            if int(message.get('size', 0)) > MAX_FILE_SIZE:
+                raise TransferError('file too large')
+            receiver = self.receivers.get(transfer_id)
+            if receiver is None or receiver.fd is None:
+                if self.open_receivers() >= MAX_RECEIVERS:
+                    raise TransferError('too many transfers')
+                receiver = FileReceiver(self, message, addr)
+                reply['have'] = receiver.open()
+                self.receivers[transfer_id] = receiver
+                log.info("file offer accepted", transfer=transfer_id, peer=receiver.peer_id,
+                         name=receiver.name, size=receiver.size, resumed_chunks=receiver.received)
+            elif message.get('from') != receiver.peer_id:
+                raise TransferError('transfer belongs to another peer')
+            else:
+                receiver.addr = addr
+                receiver.msg_id = offer_msg_id(message)
+                reply['have'] = bitmap_ranges(receiver.bitmap, receiver.chunk_count)
+            reply['ok'] = True
+        except (TransferError, KeyError, ValueError, OSError) as e:
+            reply.update(ok=False, error=str(e))
+        await self.network.send_to_address(reply, addr)
+
+    async def handle_done(self, message, addr):
+        transfer_id = message.get('transfer_id')
+        receiver = self.receivers.get(transfer_id)
+        reply = {
+            'type': 'file_complete',
+            'from': self.network.node_id,
+            'transfer_id': transfer_id,
+            'timestamp': self.network.clock().isoformat()
+        }
+        if receiver is None:
+            reply.update(ok=False, error='unknown transfer')
+        elif receiver.status == 'complete':
+            reply['ok'] = True
+        else:
+            ok, error = await receiver.finish()
+            reply['ok'] = ok
+            if error:
+                reply['error'] = error
+            if ok:
+                await self.store_received(receiver, addr)
+        await self.network.send_to_address(reply, addr)
+
+    async def store_received(self, receiver, addr):
+        db = self.network.db
+        contact = await db.get_contact_by_node_id(receiver.peer_id)
+        if not contact:
+            await db.add_contact(
+                node_id=receiver.peer_id,
+                name=f"Node_{receiver.peer_id[:8]}",
+                ip_address=addr[0],
+                port=addr[1]
+            )
+            contact = await db.get_contact_by_node_id(receiver.peer_id)
+        await db.add_message(
+            contact_id=contact['id'],
+            content=json.dumps({'name': receiver.name, 'size': receiver.size,
+                                'sha256': receiver.sha256, 'transfer_id': receiver.transfer_id}),
+            message_type='file',
+            msg_uid=receiver.msg_id
+        )
+        log.info("file received", transfer=receiver.transfer_id, peer=receiver.peer_id,
+                 name=receiver.name, size=receiver.size)
+
+    def handle_reply(self, message):
+        """Resolve the sender waiting for a file_accept / file_complete"""
+        sender = self.senders.get(message.get('transfer_id'))
+        if not sender:
+            return
+        future = sender.accepted if message.get('type') == 'file_accept' else sender.completed
+        if future and not future.done():
+            future.set_result(message)
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for receiver in self.receivers.values():
+            receiver.close()
\ No newline at end of file
@@ -0,0 +1,284 @@
+import logging
+import logging.handlers
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get('NEXPING_LOG_LEVEL', 'INFO')
+LOG_FILE = os.environ.get('NEXPING_LOG_FILE')
+LOG_FORMAT = os.environ.get('NEXPING_LOG_FORMAT', 'kv')
+
+# Events that repeat for every peer/packet and are only worth a sample
+DEFAULT_SAMPLE_RATES = {
+    'message received': 0.1,
+    'message sent': 0.1,
+}
+
+# Failures that can repeat without bound (a dead socket, a flood of bad
+# packets); every other event is never rate limited
+DEFAULT_RATE_LIMITED = (
+    'invalid json received',
+    'error handling message',
+    'udp listener error',
+    'send failed',
+    'message send failed',
+    'keep-alive send failed',
+    'discovery broadcast error',
+    'connect ack to local ip failed',
+    'connect ack to public ip failed',
+    'relay send failed',
+    'relay batch failed',
+    'relay poll failed',
+    'relayed message failed',
+    'group message from non-member dropped',
+    'group message for unknown group dropped',
+    'stun request failed',
+)
+
+_listener = None
+_queue_handler = None
+_rate_limiter = None
+_flusher = None
+_flusher_stop = None
+
+
+class StructLogger:
+    """Thin wrapper over logging.Logger taking an event name plus key/value fields"""
+
+    def __init__(self, logger):
+        self._logger = logger
+
+    def is_enabled(self, level):
+        return self._logger.isEnabledFor(level)
+
+    def _log(self, level, event, fields, exc_info=None):
+        # Level check first so disabled records cost one comparison
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def get_logger(name):
+    """Get a structured logger under the nexping namespace"""
+    return StructLogger(logging.getLogger(f"nexping.{name}"))
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a random fraction of records for the configured events"""
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        rate = self.rates.get(record.msg)
+        if rate is None or rate >= 1:
+            return True
+        return random.random() < rate
+
+
+class RateLimitFilter(logging.Filter):
+    """Allow at most `burst` records of each listed event every `interval` seconds.
+
+    Events not listed always pass. Records over the limit are dropped and
+    counted; the next record that gets through carries the count as a
+    `suppressed` field, and flush() hands out the counts of windows that
+    ended without one.
+    """
+
+    def __init__(self, events, burst=5, interval=10.0):
+        super().__init__()
+        self.events = frozenset(events)
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.msg not in self.events:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0, record.levelno]
+                if suppressed:
+                    record.fields = dict(getattr(record, 'fields', {}), suppressed=suppressed)
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+    def flush(self, force=False):
+        """Close ended windows (all with force); returns (logger, event, level, dropped) for those that dropped records"""
+        now = time.monotonic()
+        dropped = []
+        with self._lock:
+            for key, window in list(self._windows.items()):
+                if force or now - window[0] >= self.interval:
+                    del self._windows[key]
+                    if window[2]:
+                        dropped.append((*key, window[3], window[2]))
+        return dropped
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks or formats on the calling thread"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens in the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _format_value(value):
+    # Socket addresses read better as host:port
+    if isinstance(value, tuple) and len(value) == 2:
+        return f"{value[0]}:{value[1]}"
+    return str(value)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Format records as `time LEVEL logger: event key=value ...`"""
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        parts = [
+            self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            record.levelname,
+            f"{record.name.replace('nexping.', '', 1)}: {record.getMessage()}",
+        ]
+        for key, value in fields.items():
+            value = _format_value(value)
+            if not value or ' ' in value or '=' in value:
+                value = json.dumps(value, ensure_ascii=False)
+            parts.append(f"{key}={value}")
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        for key, value in (getattr(record, 'fields', None) or {}).items():
+            data[key] = value if isinstance(value, (int, float, bool, type(None))) else _format_value(value)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _report_suppressed(force=False):
+    """Log how many records the rate limiter dropped in windows that have ended"""
+    if not _rate_limiter:
+        return
+    for name, event, level, count in _rate_limiter.flush(force):
+        record = logging.getLogger(name).makeRecord(
+            name, level, __file__, 0, event, None, None, extra={'fields': {'suppressed': count}}
+        )
+        # Straight to the queue: the filters already saw these records
+        _queue_handler.enqueue(record)
+
+
+def _flush_suppressed(stop, interval):
+    while not stop.wait(interval):
+        _report_suppressed()
+
+
+def setup_logging(level=None, log_file=None, fmt=None, sample_rates=None, rate_limited=None,
+                  burst=5, interval=10.0, queue_size=10000):
+    """Route nexping logs through a bounded queue to a background writer thread"""
+    global _listener, _queue_handler, _rate_limiter, _flusher, _flusher_stop
+    if _listener:
+        return _queue_handler
+
+    level = level or LOG_LEVEL
+    log_file = log_file or LOG_FILE
+    fmt = fmt or LOG_FORMAT
+
+    if log_file:
+        target = logging.FileHandler(log_file, encoding='utf-8')
+    else:
+        target = logging.StreamHandler(sys.stderr)
+    target.setFormatter(JSONFormatter() if fmt == 'json' else KeyValueFormatter())
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    _queue_handler.addFilter(SamplingFilter(
+        DEFAULT_SAMPLE_RATES if sample_rates is None else sample_rates
+    ))
+    _rate_limiter = RateLimitFilter(
+        DEFAULT_RATE_LIMITED if rate_limited is None else rate_limited,
+        burst=burst, interval=interval
+    )
+    _queue_handler.addFilter(_rate_limiter)
+
+    root = logging.getLogger('nexping')
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.addHandler(_queue_handler)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, target)
+    _listener.start()
+    _flusher_stop = threading.Event()
+    _flusher = threading.Thread(target=_flush_suppressed, args=(_flusher_stop, interval),
+                                name='nexping-log-flush', daemon=True)
+    _flusher.start()
+    return _queue_handler
+
+
+def shutdown_logging():
+    """Report pending suppressed counts, flush queued records and stop the writer thread"""
+    global _listener, _queue_handler, _rate_limiter, _flusher, _flusher_stop
+    if not _listener:
+        return
+    _flusher_stop.set()
+    _flusher.join()
+    _report_suppressed(force=True)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    logging.getLogger('nexping').removeHandler(_queue_handler)
+    _listener = None
+    _queue_handler = None
+    _rate_limiter = None
+    _flusher = None
+    _flusher_stop = None
\ No newline at end of file
@@ -0,0 +1,68 @@
+import asyncio
+
+from logger import get_logger
+
+log = get_logger('presence')
+
+
+class PresenceTracker:
+    """In-memory online/offline state for peers.
+
+    Online/offline transitions are written to the database as they happen;
+    repeated sightings of an online peer only update last_seen in memory and
+    are flushed together every `flush_interval` seconds.
+    """
+
+    def __init__(self, db, clock, flush_interval=10):
+        self.db = db
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.online = set()
+        self.pending = {}
+
+    def is_online(self, node_id):
+        return node_id in self.online
+
+    def record(self, node_id):
+        """Mark a peer online whose contact row was just written by the caller"""
+        self.online.add(node_id)
+        self.pending.pop(node_id, None)
+
+    async def seen(self, node_id):
+        """Note that a peer is alive; returns True if it just came online"""
+        now = self.clock()
+        if node_id in self.online:
+            self.pending[node_id] = now
+            return False
+        self.online.add(node_id)
+        self.pending.pop(node_id, None)
+        await self.db.update_contact_status(node_id, True, now)
+        log.debug("peer online", peer=node_id)
+        return True
+
+    async def offline(self, node_id):
+        """Mark a peer offline; returns True if it was online"""
+        if node_id not in self.online:
+            return False
+        self.online.discard(node_id)
+        last_seen = self.pending.pop(node_id, None)
+        await self.db.update_contact_status(node_id, False, last_seen)
+        log.debug("peer offline", peer=node_id)
+        return True
+
+    async def flush(self):
+        """Write the coalesced last_seen updates in one batch"""
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        await self.db.touch_contacts(pending.items())
+        return len(pending)
+
+    async def run(self):
+        """Flush last_seen periodically until cancelled"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error("presence flush failed", error=e)
\ No newline at end of file
@@ -0,0 +1,199 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from logger import get_logger
+
+log = get_logger('profiler')
+
+# Source files whose functions are reported as hot paths
+HOT_PATH_FILES = ('server.py', 'database.py')
+
+
+class ProfileError(Exception):
+    pass
+
+
+class StackSampler(threading.Thread):
+    """Periodically sample the event loop thread's stack into collapsed-stack counts"""
+
+    def __init__(self, thread_id, interval=0.005):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write_collapsed(self, path):
+        """Write `frame;frame;frame count` lines (flamegraph.pl / speedscope input)"""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class SlowCallbackCollector(logging.Handler):
+    """Capture asyncio debug-mode "Executing ... took N seconds" warnings"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.callbacks = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if 'took' in message:
+            self.callbacks.append(message)
+
+
+class ProfileSession:
+    """Profile the running event loop for a fixed number of seconds.
+
+    Runs cProfile on the loop thread, a stack sampler for flamegraphs, an
+    event-loop lag probe and asyncio's slow-callback detection at the same time.
+    """
+
+    _active = False
+
+    def __init__(self, seconds=10, output_dir='profiles', sample_interval=0.005,
+                 slow_callback=0.05, lag_interval=0.1, top=20):
+        self.seconds = seconds
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.slow_callback = slow_callback
+        self.lag_interval = lag_interval
+        self.top = top
+        self.lags = []
+
+    async def measure_lag(self, stop):
+        """Record how late the loop wakes a sleeping task"""
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            started = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.lags.append(max(0.0, loop.time() - started - self.lag_interval))
+
+    async def run(self):
+        """Profile for `seconds` and write the stats files; returns a summary dict"""
+        if ProfileSession._active:
+            raise ProfileError("A profiling session is already running")
+        ProfileSession._active = True
+        try:
+            return await self._run()
+        finally:
+            ProfileSession._active = False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        base = os.path.join(self.output_dir, f"profile-{stamp}")
+
+        asyncio_logger = logging.getLogger('asyncio')
+        collector = SlowCallbackCollector()
+        previous_debug = loop.get_debug()
+        previous_threshold = loop.slow_callback_duration
+        previous_propagate = asyncio_logger.propagate
+        asyncio_logger.addHandler(collector)
+        asyncio_logger.propagate = False
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.slow_callback
+
+        sampler = StackSampler(threading.get_ident(), self.sample_interval)
+        profiler = cProfile.Profile()
+        stop = asyncio.Event()
+
+        log.info("profiling started", seconds=self.seconds, output=base)
+        started = time.perf_counter()
+        lag_task = asyncio.create_task(self.measure_lag(stop))
+        sampler.start()
+        profiler.enable()
+        try:
+            await asyncio.sleep(self.seconds)
+        finally:
+            profiler.disable()
+            sampler.stop()
+            stop.set()
+            await lag_task
+            loop.set_debug(previous_debug)
+            loop.slow_callback_duration = previous_threshold
+            asyncio_logger.removeHandler(collector)
+            asyncio_logger.propagate = previous_propagate
+        elapsed = time.perf_counter() - started
+
+        profiler.dump_stats(base + '.pstats')
+        stats_text = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stats_text)
+        stats.sort_stats('cumulative').print_stats(self.top * 2)
+        with open(base + '.txt', 'w') as f:
+            f.write(stats_text.getvalue())
+        sampler.write_collapsed(base + '.collapsed')
+
+        summary = {
+            'seconds': round(elapsed, 3),
+            'files': {
+                'pstats': base + '.pstats',
+                'text': base + '.txt',
+                'collapsed': base + '.collapsed',
+            },
+            'samples': sampler.samples,
+            'hot_paths': self.hot_paths(stats),
+            'loop_lag': self.lag_summary(),
+            'slow_callbacks': {
+                'threshold_ms': self.slow_callback * 1000,
+                'count': len(collector.callbacks),
+                'examples': collector.callbacks[:self.top],
+            },
+        }
+        log.info("profiling finished", samples=sampler.samples,
+                 slow_callbacks=len(collector.callbacks), output=base)
+        return summary
+
+    def hot_paths(self, stats):
+        """Top NexPing functions by cumulative time"""
+        rows = []
+        for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+            if os.path.basename(filename) in HOT_PATH_FILES:
+                rows.append({
+                    'function': f"{os.path.basename(filename)}:{line}({name})",
+                    'calls': nc,
+                    'total_ms': round(tt * 1000, 3),
+                    'cumulative_ms': round(ct * 1000, 3),
+                })
+        rows.sort(key=lambda row: row['cumulative_ms'], reverse=True)
+        return rows[:self.top]
+
+    def lag_summary(self):
+        if not self.lags:
+            return {'count': 0}
+        lags = sorted(self.lags)
+        return {
+            'count': len(lags),
+            'mean_ms': round(sum(lags) / len(lags) * 1000, 3),
+            'p99_ms': round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 3),
+            'max_ms': round(lags[-1] * 1000, 3),
+        }
\ No newline at end of file
@@ -0,0 +1,407 @@
+"""HTTP message relay for peers that cannot reach each other directly.
+
+RelayClient is used by P2PNetwork; RelayServer is the small in-memory relay
+started by `python app.py relay [port]`. Protocol:
+
+    POST /send  {"messages": [{"target": node_id, "message": {...}}, ...]}
+    GET  /poll?target=node_id&token=...&wait=25   -> {"messages": [{...}, ...]}
+    GET  /health
+
+The relay does not authenticate senders and is meant for trusted or local
+deployments. The first poll for a node ID binds it to the poller's token
+for `token_ttl` seconds, so other clients cannot drain that node's queue
+while it keeps polling.
+"""
+import asyncio
+import os
+import signal
+import time
+from collections import defaultdict, deque
+
+import aiohttp
+from aiohttp import web
+
+from logger import get_logger, setup_logging, shutdown_logging
+
+log = get_logger('relay')
+
+RELAY_PORT = 2949
+POLL_WAIT = 25
+MAX_BATCH = 100
+
+
+def parse_relays(value):
+    """Relay base URLs from a comma/space separated string"""
+    return [url.strip().rstrip('/') for url in (value or '').replace(',', ' ').split() if url.strip()]
+
+
+class RelayStats:
+    """Latency and health of one relay, used to order send attempts"""
+
+    def __init__(self, url, alpha=0.2):
+        self.url = url
+        self.alpha = alpha
+        self.latency = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def success(self, seconds):
+        self.latency = seconds if self.latency is None else (
+            self.alpha * seconds + (1 - self.alpha) * self.latency)
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def failure(self, now):
+        self.failures += 1
+        self.retry_at = now + min(60, 2 ** self.failures)
+
+    def reachable(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def healthy(self, now):
+        return self.retry_at <= now
+
+    def info(self):
+        return {
+            'url': self.url,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'failures': self.failures,
+            'healthy': self.healthy(time.monotonic()),
+        }
+
+
+class RelayClient:
+    """Send and receive messages through HTTP relays.
+
+    One pooled aiohttp session is shared by all requests. Messages queued
+    within `batch_window` seconds go out as one POST, raced against the
+    `race` fastest healthy relays; the first relay to accept wins. Racing can
+    deliver a message twice, which receivers drop by msg_id.
+    """
+
+    def __init__(self, node_id=None, relays=None, race=2, batch_window=0.02,
+                 max_batch=MAX_BATCH, timeout=5, token=None):
+        self.node_id = node_id
+        self.token = token or os.urandom(16).hex()
+        self.relays = {}
+        self.race = race
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.session = None
+        self.pending = []
+        self.flush_handle = None
+        self.tasks = set()
+        self.requests = 0
+        self.set_relays(relays if relays is not None else parse_relays(os.environ.get('NEXPING_RELAYS')))
+
+    def set_relays(self, urls):
+        self.relays = {url: self.relays.get(url) or RelayStats(url) for url in urls}
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=64, limit_per_host=8, keepalive_timeout=60,
+                                             ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    def ranked(self):
+        """Healthy relays, fastest first; untried relays count as fastest"""
+        now = time.monotonic()
+        healthy = sorted((r for r in self.relays.values() if r.healthy(now)), key=lambda r: r.latency or 0)
+        if healthy:
+            return healthy
+        # Every relay is backing off; still try the one that recovers first
+        return sorted(self.relays.values(), key=lambda r: r.retry_at)[:1]
+
+    async def send_via_relay(self, target_node, message):
+        """Queue a message for the next batch; returns True once a relay accepted it"""
+        if not self.relays:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(({'target': target_node, 'message': message}, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self.flush)
+        return await future
+
+    def flush(self):
+        """Send everything queued so far as one batch"""
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self.send_batch(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send_batch(self, batch):
+        body = {'messages': [item for item, _ in batch]}
+        try:
+            ok = await self.race_post(body)
+        except Exception as e:
+            log.warning("relay batch failed", size=len(batch), error=e)
+            ok = False
+        for _, future in batch:
+            if not future.done():
+                future.set_result(ok)
+
+    async def race_post(self, body):
+        """POST to the `race` best relays at once; True as soon as one accepts.
+
+        A failed attempt is replaced by the next relay in line.
+        """
+        candidates = self.ranked()
+        attempts = set()
+        try:
+            while candidates or attempts:
+                while candidates and len(attempts) < self.race:
+                    attempts.add(asyncio.create_task(self.post(candidates.pop(0), body)))
+                done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                if any(task.result() for task in done):
+                    return True
+            return False
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    async def post(self, relay, body):
+        started = time.monotonic()
+        self.requests += 1
+        try:
+            async with self.get_session().post(relay.url + '/send', json=body) as resp:
+                ok = resp.status == 200
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("relay send failed", relay=relay.url, error=e)
+            ok = False
+        if ok:
+            relay.success(time.monotonic() - started)
+            log.debug("message relayed", relay=relay.url, size=len(body['messages']))
+        else:
+            relay.failure(time.monotonic())
+        return ok
+
+    async def poll(self, handle, wait=POLL_WAIT):
+        """Long-poll every relay for messages addressed to us; calls `await handle(message)`"""
+        await asyncio.gather(*(self.poll_relay(relay, handle, wait) for relay in list(self.relays.values())))
+
+    async def poll_relay(self, relay, handle, wait):
+        params = {'target': self.node_id, 'token': self.token, 'wait': str(wait)}
+        timeout = aiohttp.ClientTimeout(total=wait + self.timeout)
+        while True:
+            try:
+                async with self.get_session().get(relay.url + '/poll', params=params,
+                                                  timeout=timeout) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                relay.failure(time.monotonic())
+                log.warning("relay poll failed", relay=relay.url, error=e)
+                await asyncio.sleep(relay.retry_at - time.monotonic())
+                continue
+            relay.reachable()
+            for message in data.get('messages', []):
+                try:
+                    await handle(message)
+                except Exception as e:
+                    log.error("relayed message failed", relay=relay.url, error=e)
+
+    def info(self):
+        return [relay.info() for relay in self.relays.values()]
+
+    async def close(self):
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+
+class RelayServer:
+    """In-memory store-and-forward relay with per-target queues.
+
+    Messages wait at most `ttl` seconds; each target keeps at most
+    `max_queue` of them, oldest dropped first.
+    """
+
+    def __init__(self, ttl=300, max_queue=1000, max_batch=1000, token_ttl=3600):
+        self.ttl = ttl
+        self.token_ttl = token_ttl
+        self.tokens = {}
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.queues = {}
+        self.waiters = defaultdict(set)
+        self.stats = {'accepted': 0, 'delivered': 0, 'expired': 0, 'dropped': 0}
+        self.started = time.time()
+        self.expiry_task = None
+
+    def push(self, target, message):
+        queue = self.queues.get(target)
+        if queue is None:
+            queue = self.queues[target] = deque(maxlen=self.max_queue)
+        if len(queue) == self.max_queue:
+            self.stats['dropped'] += 1
+        queue.append((time.monotonic() + self.ttl, message))
+        self.stats['accepted'] += 1
+        for waiter in self.waiters.pop(target, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def take(self, target, limit=500):
+        queue = self.queues.get(target)
+        if not queue:
+            return []
+        now = time.monotonic()
+        messages = []
+        while queue and len(messages) < limit:
+            expires, message = queue.popleft()
+            if expires > now:
+                messages.append(message)
+            else:
+                self.stats['expired'] += 1
+        if not queue:
+            del self.queues[target]
+        self.stats['delivered'] += len(messages)
+        return messages
+
+    def expire(self):
+        """Drop expired messages from the front of every queue"""
+        now = time.monotonic()
+        for target in list(self.queues):
+            queue = self.queues[target]
+            while queue and queue[0][0] <= now:
+                queue.popleft()
+                self.stats['expired'] += 1
+            if not queue:
+                del self.queues[target]
+        for target, (token, expires) in list(self.tokens.items()):
+            if expires <= now:
+                del self.tokens[target]
+
+    def authorize(self, target, token):
+        """Bind a target to the first token that polls it; False for any other token"""
+        now = time.monotonic()
+        bound = self.tokens.get(target)
+        if bound and bound[1] > now and bound[0] != token:
+            return False
+        self.tokens[target] = (token, now + self.token_ttl)
+        return True
+
+    async def expiry_loop(self):
+        while True:
+            await asyncio.sleep(max(1, self.ttl / 10))
+            self.expire()
+
+    async def handle_send(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({'error': 'Invalid JSON'}, status=400)
+        # Single {"target", "message"} bodies are accepted as a batch of one
+        items = data.get('messages', [data]) if isinstance(data, dict) else None
+        if not isinstance(items, list) or len(items) > self.max_batch:
+            return web.json_response({'error': f'messages must be a list of at most {self.max_batch}'},
+                                     status=400)
+        accepted = 0
+        for item in items:
+            if isinstance(item, dict) and isinstance(item.get('target'), str) and 'message' in item:
+                self.push(item['target'], item['message'])
+                accepted += 1
+        return web.json_response({'accepted': accepted})
+
+    async def handle_poll(self, request):
+        target = request.query.get('target')
+        token = request.query.get('token')
+        if not target or not token:
+            return web.json_response({'error': 'target and token are required'}, status=400)
+        if not self.authorize(target, token):
+            return web.json_response({'error': 'target is bound to another token'}, status=403)
+        try:
+            wait = min(max(float(request.query.get('wait', 0)), 0), 60)
+        except ValueError:
+            return web.json_response({'error': 'wait must be a number'}, status=400)
+
+        messages = self.take(target)
+        if not messages and wait:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters[target].add(waiter)
+            try:
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                waiters = self.waiters.get(target)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self.waiters[target]
+            messages = self.take(target)
+        return web.json_response({'messages': messages})
+
+    async def handle_health(self, request):
+        return web.json_response({
+            'status': 'ok',
+            'uptime': round(time.time() - self.started, 1),
+            'targets': len(self.queues),
+            'queued': sum(len(queue) for queue in self.queues.values()),
+            'waiting': sum(len(waiters) for waiters in self.waiters.values()),
+            **self.stats,
+        })
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/send', self.handle_send)
+        app.router.add_get('/poll', self.handle_poll)
+        app.router.add_get('/health', self.handle_health)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    async def on_startup(self, app):
+        self.expiry_task = asyncio.create_task(self.expiry_loop())
+
+    async def on_cleanup(self, app):
+        self.expiry_task.cancel()
+
+
+async def start_relay(host='0.0.0.0', port=RELAY_PORT, **options):
+    """Start a relay in the running loop; returns (RelayServer, AppRunner)"""
+    relay = RelayServer(**options)
+    runner = web.AppRunner(relay.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("relay ready", url=f"http://{host}:{port}")
+    return relay, runner
+
+
+def run_relay(host='0.0.0.0', port=RELAY_PORT):
+    """Run a relay server until SIGINT/SIGTERM (blocking)"""
+    setup_logging()
+
+    async def run():
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
+        relay, runner = await start_relay(host, port)
+        try:
+            await stopped.wait()
+        finally:
+            await runner.cleanup()
+            log.info("relay stopped", **relay.stats)
+
+    try:
+        asyncio.run(run())
+    finally:
+        shutdown_logging()
\ No newline at end of file
@@ -3,16 +3,35 @@ import socket
 import json
 import random
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 from cryptography.fernet import Fernet
 import base64
-import aiohttp
 from aiohttp import web
 import threading
-from database import Database
+import signal
+from database import Database, derive_uid
+from transport import UDPTransport, RECV_BUFFER
+from filetransfer import FileTransferManager, TransferError, CHUNK_MAGIC, ACK_MAGIC
+from logger import get_logger, setup_logging, shutdown_logging
+from profiler import ProfileSession, ProfileError
+from presence import PresenceTracker
+from control import ControlServer, ControlError, SOCKET_PATH
+from relay import RelayClient, parse_relays
+from backup import export_ndjson
 import hashlib
 import os
 import struct
+import uuid
+from collections import Counter, OrderedDict
+
+log = get_logger('p2p')
+stun_log = get_logger('stun')
+server_log = get_logger('server')
+
+# Source address given to handlers for messages that arrived through a relay
+RELAY_ADDR = (None, None)
+# Seconds since a peer was last heard over UDP for sends to skip the relay
+DIRECT_TIMEOUT = 60
 
 class STUNClient:
     """Клиент для получения внешнего IP и проброса NAT"""
@@ -30,12 +49,12 @@ class STUNClient:
             try:
                 result = await self.stun_request(server, port)
                 if result:
-                    print(f"STUN: Got public IP {result['public_ip']}:{result['public_port']} from {server}")
+                    stun_log.info("public address resolved", ip=result['public_ip'], port=result['public_port'], server=server)
                     return result
             except Exception as e:
-                print(f"STUN: Failed to get info from {server}: {e}")
+                stun_log.warning("stun request failed", server=server, error=e)
                 continue
-        print("STUN: All servers failed, using local IP")
+        stun_log.warning("all stun servers failed, using local ip")
         return self.get_local_info()
     
     def get_local_info(self):
@@ -74,99 +93,147 @@ class STUNClient:
             raise e
         return None
 
-class RelayClient:
-    """Клиент для ретрансляции через публичные сервера (заглушка)"""
-    def __init__(self):
-        self.relay_servers = [
-         
-        ]
+class RecentIds:
+    """Bounded LRU set of recently seen message IDs"""
+    def __init__(self, capacity=8192):
+        self.capacity = capacity
+        self.ids = OrderedDict()
     
-    async def send_via_relay(self, target_node, message):
-        """Отправить сообщение через ретранслятор"""
-        if not self.relay_servers:
-            return False
-            
-        for relay in self.relay_servers:
-            try:
-                async with aiohttp.ClientSession() as session:
-                    await session.post(relay, json={
-                        'target': target_node,
-                        'message': message,
-                        'timestamp': datetime.now().isoformat()
-                    }, timeout=5)
-                print(f"Relay: Message sent via {relay}")
-                return True
-            except Exception as e:
-                print(f"Relay: Failed to send via {relay}: {e}")
-                continue
+    def seen(self, message_id):
+        """Return True if the ID was recorded before"""
+        if message_id in self.ids:
+            self.ids.move_to_end(message_id)
+            return True
         return False
+    
+    def add(self, message_id):
+        """Record an ID once its message is stored"""
+        self.ids[message_id] = None
+        self.ids.move_to_end(message_id)
+        if len(self.ids) > self.capacity:
+            self.ids.popitem(last=False)
+
+def message_uid(message):
+    """Globally unique ID of a chat message; derived from its fields for senders that predate msg_id"""
+    uid = message.get('msg_id')
+    if uid:
+        return str(uid)[:64]
+    return derive_uid(message.get('from'), message.get('group_id'), message.get('timestamp'), message.get('content'))
 
 class P2PNetwork:
-    def __init__(self, node_id, port=2948):
+    def __init__(self, node_id, port=2948, db=None, host='0.0.0.0', use_stun=True,
+                 transport=None, clock=None, relays=None):
         self.node_id = node_id
         self.port = port
+        self.host = host
+        self.use_stun = use_stun
+        self.transport = transport
+        self.clock = clock or datetime.now
+        self.tasks = []
+        self.transfers = FileTransferManager(self)
+        self.recent_ids = RecentIds()
+        self.stats = Counter()
         self.peers = {}
         self.is_running = False
-        self.db = Database()
+        self.db = db or Database()
+        self.presence = PresenceTracker(self.db, self.clock)
         self.stun_client = STUNClient()
-        self.relay_client = RelayClient()
+        self.relay_client = RelayClient(node_id, relays)
         self.public_ip = None
         self.public_port = None
-        self.udp_socket = None
 
     async def start(self):
         """Start P2P network services"""
         self.is_running = True
         await self.db.init_db()
+        await self.db.reset_presence()
     
-        print("Getting public IP information...")
-        public_info = await self.stun_client.get_public_info()
+        if self.use_stun:
+            log.info("resolving public address")
+            public_info = await self.stun_client.get_public_info()
+        else:
+            public_info = None
+            if self.transport:
+                address = await self.transport.public_address()
+                if address:
+                    public_info = {'public_ip': address[0], 'public_port': address[1]}
+            public_info = public_info or {'public_ip': self.host, 'public_port': self.port}
         if public_info:
             self.public_ip = public_info['public_ip']
             self.public_port = public_info['public_port']
-            print(f"Public IP: {self.public_ip}:{self.public_port}")
+            log.info("public address", ip=self.public_ip, port=self.public_port)
         
         # Start UDP listener
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.udp_socket.bind(('0.0.0.0', self.port))
-        self.udp_socket.setblocking(False)
+        if self.transport is None:
+            self.transport = UDPTransport(self.host, self.port)
         
-        print(f"P2P Network started on port {self.port}")
-        print(f"Node ID: {self.node_id}")
+        log.info("p2p network started", port=self.port, node_id=self.node_id)
         
         # Start network tasks
-        asyncio.create_task(self.udp_listener())
-        asyncio.create_task(self.peer_discovery())
-        asyncio.create_task(self.keep_alive())
-        asyncio.create_task(self.network_maintenance())
+        self.tasks = [
+            asyncio.create_task(self.udp_listener()),
+            asyncio.create_task(self.peer_discovery()),
+            asyncio.create_task(self.keep_alive()),
+            asyncio.create_task(self.network_maintenance()),
+            asyncio.create_task(self.presence.run()),
+        ]
+        
+        if not self.relay_client.relays:
+            self.relay_client.set_relays(parse_relays(await self.db.get_setting('relays')))
+        if self.relay_client.relays:
+            # A stable token keeps this node's relay queues bound to it across restarts
+            token = await self.db.get_setting('relay_token')
+            if not token:
+                token = self.relay_client.token
+                await self.db.save_setting('relay_token', token)
+            self.relay_client.token = token
+            self.tasks.append(asyncio.create_task(self.relay_client.poll(self.handle_relayed)))
+            log.info("relays configured", count=len(self.relay_client.relays))
 
     async def udp_listener(self):
         """Listen for incoming UDP messages"""
-        loop = asyncio.get_event_loop()
-        
         while self.is_running:
             try:
-                # Use asyncio to handle UDP socket
-                data, addr = await loop.sock_recvfrom(self.udp_socket, 1024)
+                data, addr = await self.transport.recvfrom(RECV_BUFFER)
+                self.stats['packets_in'] += 1
+                self.stats['bytes_in'] += len(data)
                 await self.handle_message(data, addr)
             except BlockingIOError:
                 await asyncio.sleep(0.1)
             except Exception as e:
-                print(f"UDP listener error: {e}")
+                log.error("udp listener error", error=e)
                 await asyncio.sleep(1)
 
     async def handle_message(self, data, addr):
         """Handle incoming P2P messages"""
+        if data[:4] in (CHUNK_MAGIC, ACK_MAGIC):
+            self.transfers.handle_frame(data, addr)
+            return
+        
         try:
             message = json.loads(data.decode('utf-8', errors='ignore'))
+        except json.JSONDecodeError:
+            log.warning("invalid json received", addr=addr)
+            return
+        await self.dispatch(message, addr)
+
+    async def handle_relayed(self, message):
+        """Handle a message delivered by a relay poll"""
+        if isinstance(message, dict):
+            self.stats['relayed_in'] += 1
+            await self.dispatch(message, RELAY_ADDR)
+
+    async def dispatch(self, message, addr):
+        """Route a decoded message to its handler"""
+        try:
             msg_type = message.get('type')
             
             if msg_type == 'discovery':
                 await self.handle_discovery(message, addr)
             elif msg_type == 'message':
                 await self.handle_p2p_message(message, addr)
+            elif msg_type == 'group_message':
+                await self.handle_group_message(message, addr)
             elif msg_type == 'keep_alive':
                 await self.handle_keep_alive(message, addr)
             elif msg_type == 'connect_request':
@@ -175,38 +242,53 @@ class P2PNetwork:
                 await self.handle_connect_ack(message, addr)
             elif msg_type == 'peer_info':
                 await self.handle_peer_info(message, addr)
+            elif msg_type == 'file_offer':
+                await self.transfers.handle_offer(message, addr)
+            elif msg_type == 'file_done':
+                await self.transfers.handle_done(message, addr)
+            elif msg_type in ('file_accept', 'file_complete'):
+                self.transfers.handle_reply(message)
+            
+            if addr != RELAY_ADDR:
+                peer = self.peers.get(message.get('node_id') or message.get('from'))
+                if peer:
+                    peer['direct_seen'] = self.clock()
                 
-        except json.JSONDecodeError:
-            print(f"Invalid JSON received from {addr}")
         except Exception as e:
-            print(f"Error handling message from {addr}: {e}")
+            log.error("error handling message", addr=addr, error=e)
 
     async def handle_discovery(self, message, addr):
         """Handle peer discovery messages"""
         peer_id = message.get('node_id')
         if peer_id and peer_id != self.node_id:
+            known = self.peers.get(peer_id)
             peer_info = {
                 'ip': addr[0],
                 'port': addr[1],
                 'public_ip': message.get('public_ip'),
                 'public_port': message.get('public_port', self.port),
-                'last_seen': datetime.now(),
+                'last_seen': self.clock(),
                 'name': message.get('name', f"Node_{peer_id[:8]}"),
                 'local_addr': addr
             }
             
             self.peers[peer_id] = peer_info
             
-            # Save to database
-            await self.db.add_contact(
-                node_id=peer_id,
-                name=peer_info['name'],
-                ip_address=addr[0],
-                port=addr[1],
-                public_key=None 
-            )
-            
-            print(f"Discovered peer: {peer_info['name']} at {addr}")
+            # Discovery repeats every few seconds; only new peers or changed
+            # addresses are written, the rest is a presence update
+            if (known and known.get('local_addr') == addr and known.get('name') == peer_info['name']
+                    and self.presence.is_online(peer_id)):
+                await self.presence.seen(peer_id)
+            else:
+                await self.db.add_contact(
+                    node_id=peer_id,
+                    name=peer_info['name'],
+                    ip_address=addr[0],
+                    port=addr[1],
+                    public_key=None 
+                )
+                self.presence.record(peer_id)
+                log.info("peer discovered", name=peer_info['name'], addr=addr)
             
             # Send peer info to establish better connection
             await self.send_peer_info(peer_id)
@@ -218,8 +300,9 @@ class P2PNetwork:
             self.peers[peer_id].update({
                 'public_ip': message.get('public_ip'),
                 'public_port': message.get('public_port'),
-                'last_seen': datetime.now()
+                'last_seen': self.clock()
             })
+            await self.presence.seen(peer_id)
 
     async def handle_connect_request(self, message, addr):
         """Handle connection requests from remote peers"""
@@ -227,7 +310,7 @@ class P2PNetwork:
         peer_public_ip = message.get('public_ip')
         peer_public_port = message.get('public_port')
         
-        print(f"Connection request from {peer_id} at {peer_public_ip}:{peer_public_port}")
+        log.info("connection request", peer=peer_id, public_ip=peer_public_ip, public_port=peer_public_port)
         
         # Add to peers if not already
         if peer_id not in self.peers:
@@ -236,7 +319,7 @@ class P2PNetwork:
                 'port': addr[1],
                 'public_ip': peer_public_ip,
                 'public_port': peer_public_port,
-                'last_seen': datetime.now(),
+                'last_seen': self.clock(),
                 'name': f"Node_{peer_id[:8]}"
             }
         
@@ -246,68 +329,143 @@ class P2PNetwork:
             'node_id': self.node_id,
             'public_ip': self.public_ip,
             'public_port': self.public_port,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': self.clock().isoformat()
         }
         
         # Try to send ack via public IP if available
         if peer_public_ip and peer_public_port:
             try:
                 await self.send_to_address(connect_ack, (peer_public_ip, peer_public_port))
-                print(f"Sent connect ack to {peer_public_ip}:{peer_public_port}")
+                log.debug("connect ack sent", addr=(peer_public_ip, peer_public_port))
             except Exception as e:
-                print(f"Failed to send ack to public IP: {e}")
+                log.warning("connect ack to public ip failed", error=e)
         
         # Also send via local address
         try:
             await self.send_to_address(connect_ack, (addr[0], addr[1]))
         except Exception as e:
-            print(f"Failed to send ack to local IP: {e}")
+            log.warning("connect ack to local ip failed", error=e)
 
     async def handle_connect_ack(self, message, addr):
         """Handle connection acknowledgment"""
         peer_id = message.get('node_id')
-        print(f"Connection established with {peer_id}")
+        log.info("connection established", peer=peer_id)
 
     async def handle_p2p_message(self, message, addr):
         """Handle actual P2P messages"""
         from_node = message.get('from')
         content = message.get('content')
         
-        print(f"Received message from {from_node}: {content[:50] if content else 'empty'}...")
+        # The same packet may arrive over several addresses or be retried
+        uid = message_uid(message)
+        if self.recent_ids.seen(uid):
+            self.stats['duplicates'] += 1
+            log.debug("duplicate message dropped", peer=from_node, msg_id=uid)
+            return
+        
+        log.debug("message received", peer=from_node, size=len(content) if content else 0)
         
         # Store message in database
         contact = await self.db.get_contact_by_node_id(from_node)
         if contact:
-            await self.db.add_message(
-                contact_id=contact['id'],
-                content=content,
-                encrypted_content=None 
-            )
-            await self.db.update_contact_status(from_node, True)
+            await self.presence.seen(from_node)
         else:
-            # Auto-add contact if not exists
+            # Auto-add contact if not exists; relay-only senders always start here
             await self.db.add_contact(
                 node_id=from_node,
                 name=f"Node_{from_node[:8]}",
                 ip_address=addr[0],
                 port=addr[1]
             )
+            self.presence.record(from_node)
+            contact = await self.db.get_contact_by_node_id(from_node)
+        
+        stored = await self.db.add_message(
+            contact_id=contact['id'],
+            content=content,
+            encrypted_content=None,
+            msg_uid=uid
+        )
+        self.message_stored(uid, stored)
+
+    async def handle_group_message(self, message, addr):
+        """Handle messages sent to a group we are a member of"""
+        from_node = message.get('from')
+        group_id = message.get('group_id')
+        content = message.get('content')
+        if not from_node or not group_id:
+            return
+        
+        uid = message_uid(message)
+        if self.recent_ids.seen(uid):
+            self.stats['duplicates'] += 1
+            log.debug("duplicate message dropped", peer=from_node, msg_id=uid)
+            return
+        
+        log.debug("group message received", peer=from_node, group=group_id,
+                  size=len(content) if content else 0)
+        
+        # Only members may post; a group we don't know yet is only created
+        # from a contact we already know that lists both of us as members
+        contact = await self.db.get_contact_by_node_id(from_node)
+        group = await self.db.get_group(group_id)
+        members = message.get('members')
+        members = [m for m in members if isinstance(m, str) and m] if isinstance(members, list) else []
+        if group:
+            if from_node not in group['members']:
+                log.warning("group message from non-member dropped", peer=from_node, group=group_id)
+                return
+            group_pk = group['id']
+            # Members may add members
+            added = set(members) - set(group['members']) - {self.node_id}
+            if added:
+                await self.db.create_group(group_id, group['name'], sorted(added))
+        else:
+            if not contact or from_node not in members or self.node_id not in members:
+                log.warning("group message for unknown group dropped", peer=from_node, group=group_id)
+                return
+            group_pk = await self.db.create_group(
+                group_id, message.get('group_name') or f"Group_{group_id[:8]}",
+                [m for m in members if m != self.node_id]
+            )
+        await self.presence.seen(from_node)
+        
+        stored = await self.db.add_message(
+            contact_id=contact['id'],
+            content=content,
+            group_id=group_pk,
+            msg_uid=uid
+        )
+        self.message_stored(uid, stored)
+
+    def message_stored(self, uid, message_id):
+        """Remember a stored message ID; a None row id means the DB already had it"""
+        self.recent_ids.add(uid)
+        if message_id is None:
+            self.stats['duplicates'] += 1
+            log.debug("duplicate message already stored", msg_id=uid)
+        else:
+            self.stats['messages_in'] += 1
 
     async def handle_keep_alive(self, message, addr):
         """Handle keep-alive messages"""
         peer_id = message.get('node_id')
         if peer_id in self.peers:
-            self.peers[peer_id]['last_seen'] = datetime.now()
-            await self.db.update_contact_status(peer_id, True)
+            self.peers[peer_id]['last_seen'] = self.clock()
+            await self.presence.seen(peer_id)
 
     async def send_to_address(self, message, addr):
         """Send message to specific address"""
+        if addr == RELAY_ADDR:
+            return False
         try:
             data = json.dumps(message).encode('utf-8')
-            self.udp_socket.sendto(data, addr)
+            self.transport.sendto(data, addr)
+            self.stats['packets_out'] += 1
+            self.stats['bytes_out'] += len(data)
             return True
         except Exception as e:
-            print(f"Failed to send to {addr}: {e}")
+            log.warning("send failed", addr=addr, error=e)
             return False
 
     async def send_peer_info(self, peer_id):
@@ -320,7 +478,7 @@ class P2PNetwork:
             'node_id': self.node_id,
             'public_ip': self.public_ip,
             'public_port': self.public_port,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': self.clock().isoformat()
         }
         
         peer = self.peers[peer_id]
@@ -340,7 +498,7 @@ class P2PNetwork:
         # Send to all addresses
         for addr in addresses_to_try:
             if await self.send_to_address(peer_info, addr):
-                print(f"Sent peer info to {addr}")
+                log.debug("peer info sent", addr=addr)
                 break
 
     async def peer_discovery(self):
@@ -351,7 +509,7 @@ class P2PNetwork:
             'name': f"Node_{self.node_id[:8]}",
             'public_ip': self.public_ip,
             'public_port': self.public_port,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': self.clock().isoformat()
         }
         
         while self.is_running:
@@ -372,7 +530,7 @@ class P2PNetwork:
                     await self.send_to_address(discovery_msg, broadcast)
                 
             except Exception as e:
-                print(f"Discovery broadcast error: {e}")
+                log.warning("discovery broadcast error", error=e)
             
             # Random delay to reduce network noise
             await asyncio.sleep(random.uniform(15, 25))
@@ -384,7 +542,7 @@ class P2PNetwork:
             'node_id': self.node_id,
             'public_ip': self.public_ip,
             'public_port': self.public_port,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': self.clock().isoformat()
         }
         
         # Try all possible connection methods
@@ -397,7 +555,7 @@ class P2PNetwork:
                 (peer_info['public_ip'], peer_info['public_port'])
             )
             if success:
-                print(f"Connected via public IP to {peer_info['public_ip']}")
+                log.debug("connect request sent", via='public', ip=peer_info['public_ip'])
         
         # Try local IP
         if not success and peer_info.get('ip') and peer_info.get('port'):
@@ -406,70 +564,156 @@ class P2PNetwork:
                 (peer_info['ip'], peer_info['port'])
             )
             if success:
-                print(f"Connected via local IP to {peer_info['ip']}")
+                log.debug("connect request sent", via='local', ip=peer_info['ip'])
         
         # Fallback to relay
         if not success:
             success = await self.relay_client.send_via_relay(peer_info['node_id'], connect_msg)
             if success:
-                print(f"Connected via relay to {peer_info['node_id']}")
+                log.debug("connect request sent", via='relay', peer=peer_info['node_id'])
         
         return success
 
-    async def send_message(self, peer_id, message_content):
-        """Send message to specific peer"""
-        if peer_id not in self.peers:
-            print(f"Peer {peer_id} not found in network")
+    async def send_message(self, peer_id, message_content, msg_id=None):
+        """Send message to a peer or contact.
+
+        Peers heard over UDP recently get the message directly; everyone
+        else, including contacts never discovered on this network, goes
+        through the relays.
+        """
+        peer = self.peers.get(peer_id)
+        if peer is None and not await self.db.get_contact_by_node_id(peer_id):
+            log.warning("peer not found", peer=peer_id)
             return False
         
-        peer = self.peers[peer_id]
         message = {
             'type': 'message',
+            'msg_id': msg_id or uuid.uuid4().hex,
             'from': self.node_id,
             'to': peer_id,
             'content': message_content,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': self.clock().isoformat()
         }
         
         # Try all possible connection methods in order of reliability
         success = False
+        # A UDP send "succeeds" even when nothing arrives, so only trust it
+        # for peers that are answering directly (or when there is no relay)
+        direct = self.direct_reachable(peer_id)
         
-        # 1. Try local network first (fastest)
-        if peer.get('ip') and peer.get('port'):
-            success = await self.send_to_address(message, (peer['ip'], peer['port']))
-            if success:
-                print(f"Message sent to {peer_id} via local network")
-        
-        # 2. Try public IP
-        if not success and peer.get('public_ip') and peer.get('public_port'):
-            success = await self.send_to_address(
-                message, 
-                (peer['public_ip'], peer['public_port'])
-            )
-            if success:
-                print(f"Message sent to {peer_id} via public IP")
+        if peer and (direct or not self.relay_client.relays):
+            # 1. Try local network first (fastest)
+            if peer.get('ip') and peer.get('port'):
+                success = await self.send_to_address(message, (peer['ip'], peer['port']))
+                if success:
+                    log.debug("message sent", peer=peer_id, via='local')
+            
+            # 2. Try public IP
+            if not success and peer.get('public_ip') and peer.get('public_port'):
+                success = await self.send_to_address(
+                    message, 
+                    (peer['public_ip'], peer['public_port'])
+                )
+                if success:
+                    log.debug("message sent", peer=peer_id, via='public')
         
         # 3. Fallback to relay
         if not success:
             success = await self.relay_client.send_via_relay(peer_id, message)
             if success:
-                print(f"Message sent to {peer_id} via relay")
+                log.debug("message sent", peer=peer_id, via='relay')
         
-        if not success:
-            print(f"Failed to send message to {peer_id}")
+        if success:
+            self.stats['messages_out'] += 1
+        else:
+            log.warning("message send failed", peer=peer_id)
         
         return success
 
+    def direct_reachable(self, peer_id):
+        """True if the peer has a direct address and was heard over UDP recently"""
+        peer = self.peers.get(peer_id)
+        if not peer or not peer.get('direct_seen') or not self.peer_address(peer_id):
+            return False
+        return (self.clock() - peer['direct_seen']).total_seconds() < DIRECT_TIMEOUT
+
+    def peer_address(self, peer_id):
+        """Best direct address for a peer: local network first, then public"""
+        peer = self.peers.get(peer_id)
+        if not peer:
+            return None
+        if peer.get('ip') and peer.get('port'):
+            return (peer['ip'], peer['port'])
+        if peer.get('public_ip') and peer.get('public_port'):
+            return (peer['public_ip'], peer['public_port'])
+        return None
+
+    async def send_group_message(self, group_id, group_name, member_ids, message_content,
+                                 msg_id=None, batch_size=64):
+        """Send one message to every member of a group.
+
+        The datagram is encoded once and the same bytes go to every reachable
+        member, one sendto() each, in slices of `batch_size` addresses with a
+        yield to the event loop between slices; members without a direct
+        address fall back to the relay. Returns (sent peer IDs, failed peer IDs).
+        """
+        message = {
+            'type': 'group_message',
+            'msg_id': msg_id or uuid.uuid4().hex,
+            'from': self.node_id,
+            'group_id': group_id,
+            'group_name': group_name,
+            'members': [self.node_id] + list(member_ids),
+            'content': message_content,
+            'timestamp': self.clock().isoformat()
+        }
+        data = json.dumps(message).encode('utf-8')
+        
+        targets = []
+        relay_only = []
+        use_relay = bool(self.relay_client.relays)
+        for peer_id in member_ids:
+            addr = self.peer_address(peer_id)
+            if addr and (self.direct_reachable(peer_id) or not use_relay):
+                targets.append((peer_id, addr))
+            else:
+                relay_only.append(peer_id)
+        
+        sent = []
+        failed = []
+        for start in range(0, len(targets), batch_size):
+            batch = targets[start:start + batch_size]
+            failed_addrs = set(self.transport.sendto_many(data, [addr for _, addr in batch]))
+            self.stats['packets_out'] += len(batch) - len(failed_addrs)
+            self.stats['bytes_out'] += len(data) * (len(batch) - len(failed_addrs))
+            for peer_id, addr in batch:
+                if addr in failed_addrs:
+                    relay_only.append(peer_id)
+                else:
+                    sent.append(peer_id)
+            # Let the listener run between slices of a large group
+            await asyncio.sleep(0)
+        
+        # Relay sends run together so they share batched requests
+        relayed = await asyncio.gather(*(self.relay_client.send_via_relay(peer_id, message)
+                                         for peer_id in relay_only))
+        for peer_id, ok in zip(relay_only, relayed):
+            (sent if ok else failed).append(peer_id)
+        
+        self.stats['messages_out'] += 1
+        log.debug("group message sent", group=group_id, sent=len(sent), failed=len(failed))
+        return sent, failed
+
     async def keep_alive(self):
         """Send keep-alive messages to peers"""
         while self.is_running:
             keep_alive_msg = {
                 'type': 'keep_alive',
                 'node_id': self.node_id,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': self.clock().isoformat()
             }
             
-            for peer_id, peer_info in self.peers.items():
+            for peer_id, peer_info in list(self.peers.items()):
                 try:
                     # Send to last known address
                     if peer_info.get('ip') and peer_info.get('port'):
@@ -478,22 +722,22 @@ class P2PNetwork:
                             (peer_info['ip'], peer_info['port'])
                         )
                 except Exception as e:
-                    print(f"Error sending keep-alive to {peer_id}: {e}")
+                    log.warning("keep-alive send failed", peer=peer_id, error=e)
             
             await asyncio.sleep(20)  # Send keep-alive every 20 seconds
 
     async def network_maintenance(self):
         """Clean up dead peers and maintain network health"""
         while self.is_running:
-            current_time = datetime.now()
+            current_time = self.clock()
             dead_peers = []
             
-            for peer_id, peer_info in self.peers.items():
+            for peer_id, peer_info in list(self.peers.items()):
                 time_diff = (current_time - peer_info['last_seen']).total_seconds()
                 if time_diff > 60:  # 60 seconds timeout
                     dead_peers.append(peer_id)
-                    await self.db.update_contact_status(peer_id, False)
-                    print(f"Peer {peer_id} timed out")
+                    await self.presence.offline(peer_id)
+                    log.info("peer timed out", peer=peer_id)
             
             for peer_id in dead_peers:
                 del self.peers[peer_id]
@@ -501,27 +745,34 @@ class P2PNetwork:
             # Print network status
             online_peers = len([p for p in self.peers.values() 
                               if (current_time - p['last_seen']).total_seconds() < 30])
-            print(f"Network status: {online_peers} peers online, {len(self.peers)} total known")
+            log.info("network status", online=online_peers, known=len(self.peers))
             
             await asyncio.sleep(30)  # Check every 30 seconds
 
     def stop(self):
         """Stop the network"""
         self.is_running = False
-        if self.udp_socket:
-            self.udp_socket.close()
-        print("P2P Network stopped")
+        for task in self.tasks:
+            task.cancel()
+        self.transfers.close()
+        if self.transport:
+            self.transport.close()
+        log.info("p2p network stopped")
 
 class P2PServer:
-    def __init__(self, host='0.0.0.0', web_port=2947, p2p_port=2948):
+    def __init__(self, host='0.0.0.0', web_port=2947, p2p_port=2948, db_path="nexping.db", use_stun=True,
+                 control_socket=SOCKET_PATH, relays=None):
         self.host = host
         self.web_port = web_port
         self.p2p_port = p2p_port
         self.node_id = self.generate_node_id()
         self.server_name = f"Node_{self.node_id[:8]}"
         
-        self.db = Database()
-        self.network = P2PNetwork(self.node_id, p2p_port)
+        self.db = Database(db_path)
+        self.network = P2PNetwork(self.node_id, p2p_port, db=self.db, host=host, use_stun=use_stun,
+                                  relays=relays)
+        self.control = ControlServer(self, control_socket) if control_socket else None
+        self.stopped = asyncio.Event()
         self.web_app = None
         self.runner = None
         self.site = None
@@ -533,10 +784,13 @@ class P2PServer:
 
     async def start(self):
         """Start all server components"""
-        print("Initializing database...")
+        if self.control:
+            await self.control.start()
+        
+        server_log.info("initializing database")
         await self.db.init_db()
         
-        print("Starting P2P network...")
+        server_log.info("starting p2p network")
         await self.network.start()
         
         # Add self to contacts
@@ -547,7 +801,7 @@ class P2PServer:
             port=self.p2p_port
         )
         
-        print(f"Server started: {self.server_name} ({self.node_id})")
+        server_log.info("server started", name=self.server_name, node_id=self.node_id)
 
     async def start_web_interface(self):
         """Start HTTP server for web interface"""
@@ -558,7 +812,15 @@ class P2PServer:
         app.router.add_get('/contacts', self.handle_contacts)
         app.router.add_post('/send_message', self.handle_send_message)
         app.router.add_get('/messages', self.handle_get_messages)
+        app.router.add_post('/mark_read', self.handle_mark_read)
+        app.router.add_get('/groups', self.handle_get_groups)
+        app.router.add_post('/groups', self.handle_create_group)
+        app.router.add_post('/upload', self.handle_upload)
+        app.router.add_get('/download', self.handle_download)
+        app.router.add_get('/transfers', self.handle_transfers)
         app.router.add_get('/favicon.ico', self.serve_favicon)
+        app.router.add_post('/admin/profile', self.handle_profile)
+        app.router.add_get('/export', self.handle_export)
         app.router.add_static('/', path=os.path.dirname(__file__))
         
         self.web_app = app
@@ -568,8 +830,7 @@ class P2PServer:
         self.site = web.TCPSite(self.runner, self.host, self.web_port)
         await self.site.start()
         
-        print(f"Web interface: http://{self.host}:{self.web_port}")
-        print("NexPing server is ready!")
+        server_log.info("web interface ready", url=f"http://{self.host}:{self.web_port}")
 
     async def serve_favicon(self, request):
         """Serve favicon - return empty for now"""
@@ -595,7 +856,11 @@ class P2PServer:
                 'status': 'online' if contact['is_online'] else 'offline',
                 'last_seen': self.format_last_seen(contact['last_seen']),
                 'node_id': contact['node_id'],
-                'id': contact['id']
+                'id': contact['id'],
+                'last_message': contact['last_snippet'],
+                'last_message_id': contact['last_message_id'],
+                'last_message_time': self.format_last_seen(contact['last_timestamp'], utc=True) if contact['last_timestamp'] else None,
+                'unread_count': contact['unread_count']
             })
         
         return web.json_response({
@@ -604,11 +869,122 @@ class P2PServer:
             'node_id': self.node_id
         })
 
+    async def handle_mark_read(self, request):
+        """API endpoint: mark a conversation read (optionally up to a message id)"""
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({'success': False, 'error': 'Invalid JSON'}, status=400)
+        
+        up_to_id = data.get('up_to_id')
+        # SQLite orders any INTEGER below any TEXT, so a string would mark everything read
+        if up_to_id is not None and (not isinstance(up_to_id, int) or isinstance(up_to_id, bool)):
+            return web.json_response({'success': False, 'error': 'up_to_id must be an integer'}, status=400)
+        if data.get('group_id'):
+            group = await self.db.get_group(data['group_id'])
+            if not group:
+                return web.json_response({'success': False, 'error': 'Group not found'}, status=404)
+            updated = await self.db.mark_read(group_id=group['id'], up_to_id=up_to_id)
+        elif data.get('contact_node_id'):
+            contact = await self.db.get_contact_by_node_id(data['contact_node_id'])
+            if not contact:
+                return web.json_response({'success': False, 'error': 'Contact not found'}, status=404)
+            updated = await self.db.mark_read(contact_id=contact['id'], up_to_id=up_to_id)
+        else:
+            return web.json_response({'success': False, 'error': 'contact_node_id or group_id required'}, status=400)
+        
+        return web.json_response({'success': True, 'updated': updated})
+
+    async def handle_get_groups(self, request):
+        """API endpoint for groups"""
+        groups = await self.db.get_groups()
+        return web.json_response({'groups': [{
+            'group_id': group['group_id'],
+            'name': group['name'],
+            'members': group['members'],
+            'id': group['id'],
+            'last_message': group['last_snippet'],
+            'last_message_id': group['last_message_id'],
+            'last_message_time': self.format_last_seen(group['last_timestamp'], utc=True) if group['last_timestamp'] else None,
+            'unread_count': group['unread_count']
+        } for group in groups]})
+
+    async def handle_create_group(self, request):
+        """API endpoint for creating a group"""
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({'success': False, 'error': 'Invalid JSON'}, status=400)
+        
+        name = data.get('name')
+        members = data.get('members')
+        if not isinstance(members, list) or not all(isinstance(m, str) and m for m in members):
+            return web.json_response({'success': False, 'error': 'members must be a list of node IDs'}, status=400)
+        members = [m for m in members if m != self.node_id]
+        if not isinstance(name, str) or not name or not members:
+            return web.json_response({'success': False, 'error': 'Missing parameters'}, status=400)
+        
+        group_id = os.urandom(8).hex()
+        await self.db.create_group(group_id, name, members)
+        group = await self.db.get_group(group_id)
+        return web.json_response({
+            'success': True,
+            'group_id': group_id,
+            'members': group['members']
+        })
+
+    async def handle_upload(self, request):
+        """API endpoint: stream the request body to disk and send it to a contact as a file"""
+        contact_node_id = request.query.get('contact_node_id')
+        name = request.query.get('name')
+        if not contact_node_id or not name:
+            return web.json_response({'success': False, 'error': 'contact_node_id and name required'}, status=400)
+        
+        contact = await self.db.get_contact_by_node_id(contact_node_id)
+        if not contact:
+            return web.json_response({'success': False, 'error': 'Contact not found'}, status=404)
+        
+        transfers = self.network.transfers
+        try:
+            tmp_path = await transfers.store_upload(request.content)
+        except TransferError as e:
+            return web.json_response({'success': False, 'error': str(e)}, status=413)
+        
+        try:
+            transfer_id = await transfers.send_file(contact_node_id, tmp_path, name, keep_copy=True)
+        except TransferError as e:
+            os.remove(tmp_path)
+            return web.json_response({'success': False, 'error': str(e)})
+        
+        return web.json_response({'success': True, 'transfer_id': transfer_id})
+
+    async def handle_download(self, request):
+        """API endpoint: stream a sent or received file (sendfile, no buffering)"""
+        path = self.network.transfers.file_path(request.query.get('transfer_id'))
+        if not path:
+            return web.json_response({'error': 'File not found'}, status=404)
+        
+        return web.FileResponse(path, headers={
+            'Content-Disposition': f'attachment; filename="{os.path.basename(path)}"'
+        })
+
+    async def handle_transfers(self, request):
+        """API endpoint for file transfer progress"""
+        return web.json_response({'transfers': self.network.transfers.transfers()})
+
     async def handle_get_messages(self, request):
-        """API endpoint to get messages for a contact"""
+        """API endpoint to get messages for a contact or group"""
+        group_id = request.query.get('group_id')
+        if group_id:
+            group = await self.db.get_group(group_id)
+            if not group:
+                return web.json_response({'error': 'Group not found'}, status=404)
+            messages = await self.db.get_group_messages(group['id'])
+            return web.json_response({'messages': messages})
+        
         contact_node_id = request.query.get('contact_node_id')
         if not contact_node_id:
-            return web.json_response({'error': 'contact_node_id required'}, status=400)
+            return web.json_response({'error': 'contact_node_id or group_id required'}, status=400)
         
         contact = await self.db.get_contact_by_node_id(contact_node_id)
         if not contact:
@@ -622,8 +998,12 @@ class P2PServer:
         try:
             data = await request.json()
             contact_node_id = data.get('contact_node_id')
+            group_id = data.get('group_id')
             message_content = data.get('message')
             
+            if group_id and message_content:
+                return await self.send_group_message(group_id, message_content)
+            
             if not contact_node_id or not message_content:
                 return web.json_response({'success': False, 'error': 'Missing parameters'})
             
@@ -633,13 +1013,16 @@ class P2PServer:
                 return web.json_response({'success': False, 'error': 'Contact not found'})
             
             # Store message locally
+            msg_uid = uuid.uuid4().hex
             message_id = await self.db.add_message(
                 contact_id=contact['id'],
-                content=message_content
+                content=message_content,
+                is_outgoing=True,
+                msg_uid=msg_uid
             )
             
             # Send via P2P network
-            success = await self.network.send_message(contact_node_id, message_content)
+            success = await self.network.send_message(contact_node_id, message_content, msg_id=msg_uid)
             
             return web.json_response({
                 'success': success,
@@ -647,11 +1030,78 @@ class P2PServer:
             })
         
         except Exception as e:
-            print(f"Error sending message: {e}")
+            server_log.error("error sending message", error=e)
             return web.json_response({'success': False, 'error': str(e)})
 
-    def format_last_seen(self, timestamp):
-        """Format timestamp for display"""
+    def is_local_request(self, request):
+        """Admin endpoints only answer the machine the node runs on"""
+        return request.remote in ('127.0.0.1', '::1')
+
+    async def handle_export(self, request):
+        """Admin endpoint: stream the chat history as NDJSON (?compress=1 for gzip)"""
+        if not self.is_local_request(request):
+            return web.json_response({'error': 'Forbidden'}, status=403)
+        
+        compress = request.query.get('compress', '0') not in ('0', 'false', '')
+        filename = f"nexping-export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson"
+        if compress:
+            filename += '.gz'
+        
+        response = web.StreamResponse(headers={
+            'Content-Type': 'application/gzip' if compress else 'application/x-ndjson',
+            'Content-Disposition': f'attachment; filename="{filename}"'
+        })
+        await response.prepare(request)
+        await export_ndjson(self.db, response.write, compress=compress)
+        await response.write_eof()
+        return response
+
+    async def handle_profile(self, request):
+        """Admin endpoint: profile the running server for N seconds (localhost only)"""
+        if not self.is_local_request(request):
+            return web.json_response({'error': 'Forbidden'}, status=403)
+        
+        try:
+            seconds = float(request.query.get('seconds', 10))
+        except ValueError:
+            return web.json_response({'error': 'seconds must be a number'}, status=400)
+        if not 0 < seconds <= 300:
+            return web.json_response({'error': 'seconds must be between 0 and 300'}, status=400)
+        
+        try:
+            summary = await ProfileSession(seconds=seconds).run()
+        except ProfileError as e:
+            return web.json_response({'error': str(e)}, status=409)
+        return web.json_response(summary)
+
+    async def send_group_message(self, group_id, message_content):
+        """Store a group message once and fan it out to all members"""
+        group = await self.db.get_group(group_id)
+        if not group:
+            return web.json_response({'success': False, 'error': 'Group not found'})
+        
+        msg_uid = uuid.uuid4().hex
+        message_id = await self.db.add_message(
+            contact_id=None,
+            content=message_content,
+            group_id=group['id'],
+            is_outgoing=True,
+            msg_uid=msg_uid
+        )
+        
+        sent, failed = await self.network.send_group_message(
+            group_id, group['name'], group['members'], message_content, msg_id=msg_uid
+        )
+        
+        return web.json_response({
+            'success': bool(sent) and not failed,
+            'message_id': message_id,
+            'sent': sent,
+            'failed': failed
+        })
+
+    def format_last_seen(self, timestamp, utc=False):
+        """Format timestamp for display; utc=True for SQLite CURRENT_TIMESTAMP values"""
         if not timestamp:
             return 'unknown'
         
@@ -661,6 +1111,12 @@ class P2PServer:
             except:
                 return timestamp
         
+        # Message timestamps are UTC (SQLite CURRENT_TIMESTAMP); last_seen and now are local
+        if utc and timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone().replace(tzinfo=None)
+        
         now = datetime.now()
         diff = now - timestamp
         
@@ -673,17 +1129,28 @@ class P2PServer:
         else:
             return timestamp.strftime('%Y-%m-%d %H:%M')
 
+    def request_stop(self):
+        """Ask the run loop to shut down gracefully"""
+        self.stopped.set()
+
     async def stop(self):
-        """Stop the server"""
-        print("Stopping NexPing server...")
-        self.network.stop()
-        
+        """Stop the server: close the control socket and web, drain the network, flush the DB"""
+        server_log.info("stopping server")
+        if self.control:
+            await self.control.close()
         if self.site:
             await self.site.stop()
+        
+        await self.network.presence.flush()
+        self.network.stop()
+        await asyncio.gather(*self.network.tasks, *self.network.transfers.tasks, return_exceptions=True)
+        await self.network.relay_client.close()
+        await self.db.checkpoint()
+        
         if self.runner:
             await self.runner.cleanup()
         
-        print("Server stopped")
+        server_log.info("server stopped")
 
 async def start_server_async():
     """Start server asynchronously"""
@@ -693,23 +1160,30 @@ async def start_server_async():
     return server
 
 def start_server():
-    """Start the P2P server (blocking)"""
+    """Start the P2P server (blocking until stopped)"""
+    setup_logging()
     server = P2PServer()
     
     # Run in asyncio event loop
     async def run():
-        await server.start()
-        await server.start_web_interface()
-        
-        # Keep running
-        while True:
-            await asyncio.sleep(1)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, server.request_stop)
+        try:
+            await server.start()
+        except ControlError as e:
+            server_log.error("startup failed", error=e)
+            return
+        try:
+            await server.start_web_interface()
+            await server.stopped.wait()
+        finally:
+            await server.stop()
     
     try:
         asyncio.run(run())
-    except KeyboardInterrupt:
-        print("\nShutting down...")
-        asyncio.run(server.stop())
+    finally:
+        shutdown_logging()
 
 if __name__ == "__main__":
     start_server()
\ No newline at end of file
@@ -0,0 +1,537 @@
+"""In-process virtual network for scaling tests of the P2P protocol.
+
+Runs many P2PNetwork instances in a single event loop whose clock is virtual:
+whenever every node is idle the loop jumps straight to the next timer, so
+minutes of protocol time take as long as the packets they generate. Nodes
+talk through SimulatedTransport objects that model latency, loss, NAT and
+partitions.
+
+    python simulator.py --nodes 2000 --lans 20 --minutes 5
+    python simulator.py --nodes 500 --partition-at 120 --heal-at 240 --output sim.json
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import random
+import selectors
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from logger import setup_logging, shutdown_logging
+from server import P2PNetwork
+from transport import Transport
+
+SIM_EPOCH = datetime(2024, 1, 1)
+BROADCAST = '255.255.255.255'
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class VirtualClockSelector(selectors.BaseSelector):
+    """Selector that never sleeps: an idle wait advances the virtual clock instead"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def close(self):
+        self._selector.close()
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if not events and timeout:
+            self.clock.advance(timeout)
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop whose time() is the virtual clock"""
+
+    def __init__(self):
+        self.clock = VirtualClock()
+        super().__init__(VirtualClockSelector(self.clock))
+
+    def time(self):
+        return self.clock.now
+
+
+class SimulatedDatabase:
+    """In-memory stand-in for Database so thousands of nodes need no SQLite files"""
+
+    def __init__(self):
+        self.contacts = {}
+        self.messages = []
+        self.message_uids = set()
+        self.groups = {}
+        self.settings = {}
+
+    async def init_db(self):
+        pass
+
+    async def add_contact(self, node_id, name, ip_address=None, port=None, public_key=None):
+        contact = self.contacts.get(node_id)
+        if contact is None:
+            contact = self.contacts[node_id] = {'id': len(self.contacts) + 1, 'node_id': node_id,
+                                                'ip_address': None, 'port': None, 'public_key': None}
+        contact.update(name=name, is_online=True,
+                       ip_address=ip_address or contact['ip_address'],
+                       port=port or contact['port'],
+                       public_key=public_key or contact['public_key'])
+
+    async def get_contacts(self):
+        return list(self.contacts.values())
+
+    async def update_contact_status(self, node_id, is_online, last_seen=None):
+        if node_id in self.contacts:
+            self.contacts[node_id]['is_online'] = is_online
+            if last_seen is not None:
+                self.contacts[node_id]['last_seen'] = last_seen
+
+    async def touch_contacts(self, seen):
+        for node_id, timestamp in seen:
+            if node_id in self.contacts:
+                self.contacts[node_id]['last_seen'] = timestamp
+
+    async def reset_presence(self):
+        for contact in self.contacts.values():
+            contact['is_online'] = False
+
+    async def add_message(self, contact_id, content, message_type="text", encrypted_content=None,
+                          group_id=None, is_outgoing=False, msg_uid=None):
+        if msg_uid is not None:
+            if msg_uid in self.message_uids:
+                return None
+            self.message_uids.add(msg_uid)
+        self.messages.append((contact_id, message_type, content, group_id))
+        return len(self.messages)
+
+    async def get_messages(self, contact_id, limit=100):
+        return [m for m in self.messages if m[0] == contact_id and m[3] is None][:limit]
+
+    async def create_group(self, group_id, name, member_node_ids):
+        for node_id in member_node_ids:
+            if node_id not in self.contacts:
+                self.contacts[node_id] = {'id': len(self.contacts) + 1, 'node_id': node_id,
+                                          'name': f"Node_{node_id[:8]}", 'ip_address': None,
+                                          'port': None, 'public_key': None, 'is_online': False}
+        group = self.groups.setdefault(group_id, {
+            'id': len(self.groups) + 1, 'group_id': group_id, 'name': name, 'members': []
+        })
+        group['members'] = sorted(set(group['members']) | set(member_node_ids))
+        return group['id']
+
+    async def get_group(self, group_id):
+        return self.groups.get(group_id)
+
+    async def get_contact_by_node_id(self, node_id):
+        return self.contacts.get(node_id)
+
+    async def save_setting(self, key, value):
+        self.settings[key] = value
+
+    async def get_setting(self, key, default=None):
+        return self.settings.get(key, default)
+
+
+class NAT:
+    """Address translation for one LAN.
+
+    kind is 'cone' (any remote may use a mapping), 'restricted' (only remotes
+    the host has sent to) or 'symmetric' (a new mapping per destination).
+    """
+
+    def __init__(self, public_ip, kind='restricted'):
+        self.public_ip = public_ip
+        self.kind = kind
+        self.mappings = {}
+        self.reverse = {}
+        self.permitted = defaultdict(set)
+        self.next_port = 40000
+
+    def outbound(self, private_addr, dest):
+        key = (private_addr, dest) if self.kind == 'symmetric' else private_addr
+        port = self.mappings.get(key)
+        if port is None:
+            port = self.mappings[key] = self.next_port
+            self.reverse[port] = private_addr
+            self.next_port += 1
+        self.permitted[port].add(dest)
+        return (self.public_ip, port)
+
+    def inbound(self, port, source):
+        private_addr = self.reverse.get(port)
+        if private_addr is None:
+            return None
+        if self.kind != 'cone' and source not in self.permitted[port]:
+            return None
+        return private_addr
+
+
+class SimulatedTransport(Transport):
+    def __init__(self, network, addr, lan):
+        self.network = network
+        self.addr = addr
+        self.lan = lan
+        self.inbox = asyncio.Queue()
+        self.closed = False
+        self.sent = Counter()
+        self.received = 0
+
+    def sendto(self, data, addr):
+        if self.closed:
+            raise OSError("transport closed")
+        self.sent[packet_type(data)] += 1
+        self.network.route(self, bytes(data), tuple(addr))
+
+    async def recvfrom(self, bufsize):
+        data, addr = await self.inbox.get()
+        return data[:bufsize], addr
+
+    async def public_address(self):
+        # What a STUN server would have reported
+        nat = self.network.nats.get(self.lan)
+        if nat:
+            return nat.outbound(self.addr, ('stun', 3478))
+        return self.addr
+
+    def deliver(self, data, source):
+        if self.closed:
+            return
+        if self.inbox.qsize() >= self.network.buffer:
+            self.network.dropped['buffer'] += 1
+            return
+        self.received += 1
+        self.inbox.put_nowait((data, source))
+
+    def close(self):
+        self.closed = True
+
+
+def packet_type(data):
+    # P2PNetwork always serializes 'type' first: {"type": "discovery", ...}
+    if data[:10] == b'{"type": "':
+        end = data.find(b'"', 10)
+        if end > 0:
+            return data[10:end].decode('ascii', 'replace')
+    return 'other'
+
+
+class SimulatedNetwork:
+    """Routes datagrams between SimulatedTransports with latency, loss, NAT and partitions"""
+
+    def __init__(self, latency=0.02, jitter=0.01, loss=0.0, buffer=1024, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.buffer = buffer
+        self.random = random.Random(seed)
+        self.hosts = {}
+        self.lans = defaultdict(list)
+        self.nats = {}
+        self.lan_index = {}
+        self.partition_of = None
+        self.dropped = Counter()
+
+    def add_lan(self, lan, nat=None):
+        index = self.lan_index.setdefault(lan, len(self.lan_index))
+        if nat:
+            self.nats[lan] = NAT(f"198.51.{index // 256}.{index % 256}", nat)
+        return index
+
+    def add_host(self, lan, port=2948):
+        index = self.add_lan(lan)
+        host_index = len(self.lans[lan]) + 1
+        addr = (f"10.{index}.{host_index // 256}.{host_index % 256}", port)
+        transport = SimulatedTransport(self, addr, lan)
+        self.hosts[addr] = transport
+        self.lans[lan].append(transport)
+        return transport
+
+    def partition(self, groups):
+        """Split hosts into groups (iterables of transports); traffic between groups is dropped"""
+        self.partition_of = {}
+        for i, group in enumerate(groups):
+            for transport in group:
+                self.partition_of[transport.addr] = i
+
+    def heal(self):
+        self.partition_of = None
+
+    def route(self, source, data, dest):
+        if dest[0] == BROADCAST:
+            for transport in self.lans[source.lan]:
+                if transport is not source and transport.addr[1] == dest[1]:
+                    self.schedule(source, transport, data, source.addr)
+            return
+
+        target = self.hosts.get(dest)
+        if target is not None and target.lan == source.lan:
+            self.schedule(source, target, data, source.addr)
+            return
+
+        # Crossing LANs: apply the sender's NAT, then the receiver's
+        nat = self.nats.get(source.lan)
+        seen_as = nat.outbound(source.addr, dest) if nat else source.addr
+        if target is None:
+            lan = next((lan for lan, n in self.nats.items() if n.public_ip == dest[0]), None)
+            private_addr = self.nats[lan].inbound(dest[1], seen_as) if lan else None
+            target = self.hosts.get(private_addr)
+            if target is None:
+                self.dropped['nat' if lan else 'unreachable'] += 1
+                return
+        elif target.lan in self.nats:
+            # Private address of another NATed LAN is not routable
+            self.dropped['unreachable'] += 1
+            return
+        self.schedule(source, target, data, seen_as)
+
+    def schedule(self, source, target, data, seen_as):
+        if self.partition_of is not None and \
+                self.partition_of.get(source.addr) != self.partition_of.get(target.addr):
+            self.dropped['partition'] += 1
+            return
+        if self.loss and self.random.random() < self.loss:
+            self.dropped['loss'] += 1
+            return
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        asyncio.get_running_loop().call_later(delay, target.deliver, data, seen_as)
+
+
+class Simulation:
+    def __init__(self, nodes=100, lans=1, nat=None, nat_ratio=0.0, latency=0.02, jitter=0.01,
+                 loss=0.0, bootstrap=0, seed=None):
+        self.random = random.Random(seed)
+        self.net = SimulatedNetwork(latency=latency, jitter=jitter, loss=loss, seed=seed)
+        self.bootstrap = bootstrap
+        self.nodes = []
+        self.expected = {}
+        self.convergence = []
+        self.timeline = []
+
+        for i in range(lans):
+            behind_nat = nat and self.random.random() < nat_ratio
+            self.net.add_lan(f"lan{i}", nat if behind_nat else None)
+        for i in range(nodes):
+            transport = self.net.add_host(f"lan{i % lans}")
+            self.nodes.append(P2PNetwork(
+                node_id=f"{i:016x}",
+                db=SimulatedDatabase(),
+                host=transport.addr[0],
+                use_stun=False,
+                transport=transport,
+                clock=self.now,
+            ))
+
+    def now(self):
+        return SIM_EPOCH + timedelta(seconds=asyncio.get_running_loop().time())
+
+    def compute_expected(self):
+        """Peers each node should know (same LAN and partition) and must forget (other partitions)"""
+        by_lan = defaultdict(set)
+        for node in self.nodes:
+            by_lan[node.transport.lan].add(node.node_id)
+        partition_of = self.net.partition_of
+        self.expected = {}
+        for node in self.nodes:
+            expected = by_lan[node.transport.lan] - {node.node_id}
+            unreachable = set()
+            if partition_of is not None:
+                group = partition_of.get(node.transport.addr)
+                unreachable = {n.node_id for n in self.nodes
+                               if partition_of.get(n.transport.addr) != group}
+                expected -= unreachable
+            self.expected[node.node_id] = (expected, unreachable)
+
+    def converged_fraction(self):
+        done = 0
+        for node in self.nodes:
+            expected, unreachable = self.expected[node.node_id]
+            known = node.peers.keys()
+            if expected <= known and not (unreachable and unreachable & known):
+                done += 1
+        return done / len(self.nodes)
+
+    async def watch_convergence(self, label, started, interval=1.0):
+        """Record the virtual time at which every node knows all of its expected peers"""
+        loop = asyncio.get_running_loop()
+        seconds = None
+        try:
+            while self.converged_fraction() < 1.0:
+                await asyncio.sleep(interval)
+            seconds = round(loop.time() - started, 3)
+        finally:
+            # A phase cut short by the next event (or the end of the run) reports None
+            self.convergence.append({
+                'phase': label,
+                'started_at': round(started, 3),
+                'seconds': seconds,
+            })
+
+    async def sample(self, interval=10.0):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            self.timeline.append({
+                't': round(loop.time(), 1),
+                'converged': round(self.converged_fraction(), 4),
+                'packets': sum(sum(n.transport.sent.values()) for n in self.nodes),
+            })
+
+    async def run(self, minutes, partition_at=None, heal_at=None):
+        loop = asyncio.get_running_loop()
+        wall_started = time.perf_counter()
+        for node in self.nodes:
+            await node.start()
+
+        if self.bootstrap:
+            for node in self.nodes:
+                others = self.random.sample(self.nodes, min(self.bootstrap + 1, len(self.nodes)))
+                for other in others:
+                    if other is not node:
+                        await node.connect_to_peer({
+                            'node_id': other.node_id,
+                            'public_ip': other.public_ip,
+                            'public_port': other.public_port,
+                        })
+
+        self.compute_expected()
+        watchers = [asyncio.create_task(self.watch_convergence('startup', loop.time()))]
+        sampler = asyncio.create_task(self.sample())
+
+        events = []
+        if partition_at is not None:
+            heapq.heappush(events, (partition_at, 'partition'))
+        if heal_at is not None:
+            heapq.heappush(events, (heal_at, 'heal'))
+        duration = minutes * 60
+        while events and events[0][0] < duration:
+            at, event = heapq.heappop(events)
+            await asyncio.sleep(max(0.0, at - loop.time()))
+            if event == 'partition':
+                half = len(self.nodes) // 2
+                self.net.partition([
+                    [n.transport for n in self.nodes[:half]],
+                    [n.transport for n in self.nodes[half:]],
+                ])
+            else:
+                self.net.heal()
+            for task in watchers:
+                task.cancel()
+            await asyncio.gather(*watchers, return_exceptions=True)
+            self.compute_expected()
+            watchers.append(asyncio.create_task(self.watch_convergence(event, loop.time())))
+        await asyncio.sleep(max(0.0, duration - loop.time()))
+
+        for task in watchers + [sampler]:
+            task.cancel()
+        await asyncio.gather(*watchers, sampler, return_exceptions=True)
+        for node in self.nodes:
+            node.stop()
+        return self.report(loop.time(), time.perf_counter() - wall_started)
+
+    def report(self, virtual_seconds, wall_seconds):
+        minutes = virtual_seconds / 60
+        sent = Counter()
+        received = 0
+        for node in self.nodes:
+            sent.update(node.transport.sent)
+            received += node.transport.received
+        count = len(self.nodes)
+        return {
+            'nodes': count,
+            'lans': len(self.net.lan_index),
+            'nat_lans': len(self.net.nats),
+            'virtual_seconds': round(virtual_seconds, 3),
+            'wall_seconds': round(wall_seconds, 3),
+            'packets_sent': sum(sent.values()),
+            'packets_received': received,
+            'sent_per_node_per_minute': round(sum(sent.values()) / count / minutes, 2),
+            'received_per_node_per_minute': round(received / count / minutes, 2),
+            'sent_per_node_per_minute_by_type': {
+                kind: round(n / count / minutes, 2) for kind, n in sorted(sent.items())
+            },
+            'dropped': dict(self.net.dropped),
+            'convergence': self.convergence,
+            'converged_fraction': round(self.converged_fraction(), 4),
+            'timeline': self.timeline,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NexPing virtual network simulator')
+    parser.add_argument('--nodes', type=int, default=200)
+    parser.add_argument('--lans', type=int, default=1, help='broadcast domains to spread nodes over')
+    parser.add_argument('--nat', choices=['cone', 'restricted', 'symmetric'], help='NAT type for NATed LANs')
+    parser.add_argument('--nat-ratio', type=float, default=0.0, help='fraction of LANs behind NAT')
+    parser.add_argument('--latency', type=float, default=0.02, help='one-way latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='extra random latency in seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='packet loss probability')
+    parser.add_argument('--bootstrap', type=int, default=0, help='connect_request to N random nodes at start')
+    parser.add_argument('--minutes', type=float, default=5, help='virtual minutes to simulate')
+    parser.add_argument('--partition-at', type=float, help='virtual second to split the nodes in half')
+    parser.add_argument('--heal-at', type=float, help='virtual second to heal the partition')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    setup_logging(level='WARNING')
+    simulation = Simulation(
+        nodes=args.nodes, lans=args.lans, nat=args.nat, nat_ratio=args.nat_ratio,
+        latency=args.latency, jitter=args.jitter, loss=args.loss,
+        bootstrap=args.bootstrap, seed=args.seed,
+    )
+    loop = VirtualTimeLoop()
+    try:
+        report = loop.run_until_complete(
+            simulation.run(args.minutes, args.partition_at, args.heal_at)
+        )
+    finally:
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+        shutdown_logging()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print(f"{report['nodes']} nodes, {report['lans']} LANs ({report['nat_lans']} behind NAT), "
+          f"{report['virtual_seconds']}s virtual in {report['wall_seconds']}s wall")
+    print(f"Packets/node/min: sent {report['sent_per_node_per_minute']}, "
+          f"received {report['received_per_node_per_minute']}")
+    for kind, rate in report['sent_per_node_per_minute_by_type'].items():
+        print(f"  {kind:16} {rate}")
+    print(f"Dropped: {report['dropped']}")
+    for phase in report['convergence']:
+        if phase['seconds'] is None:
+            print(f"Did not converge after {phase['phase']} (t={phase['started_at']}s)")
+        else:
+            print(f"Converged after {phase['phase']} in {phase['seconds']}s")
+    if report['converged_fraction'] < 1:
+        print(f"Not converged: {report['converged_fraction']:.1%} of nodes know all expected peers")
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
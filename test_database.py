@@ -0,0 +1,204 @@
+import asyncio
+
+import aiosqlite
+import pytest
+
+from database import Database, derive_uid
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / 'nexping.db'))
+    run(database.init_db())
+    return database
+
+
+async def add_peer(db, node_id='peer0001'):
+    await db.add_contact(node_id, f"Node_{node_id}", '10.0.0.2', 2948)
+    return (await db.get_contact_by_node_id(node_id))['id']
+
+
+async def contact_summary(db, node_id='peer0001'):
+    return next(c for c in await db.get_contacts() if c['node_id'] == node_id)
+
+
+def test_incoming_messages_count_as_unread(db):
+    async def scenario():
+        contact_id = await add_peer(db)
+        for content in ('one', 'two', 'three'):
+            await db.add_message(contact_id=contact_id, content=content)
+        last_id = await db.add_message(contact_id=contact_id, content='reply', is_outgoing=True)
+        return last_id, await contact_summary(db)
+
+    last_id, summary = run(scenario())
+    assert summary['unread_count'] == 3
+    assert summary['last_message_id'] == last_id
+    assert summary['last_snippet'] == 'reply'
+
+
+def test_mark_read_up_to_id(db):
+    async def scenario():
+        contact_id = await add_peer(db)
+        ids = [await db.add_message(contact_id=contact_id, content=str(i)) for i in range(4)]
+        results = [await db.mark_read(contact_id=contact_id, up_to_id=ids[1])]
+        results.append((await contact_summary(db))['unread_count'])
+        results.append(await db.mark_read(contact_id=contact_id))
+        results.append((await contact_summary(db))['unread_count'])
+        results.append(await db.mark_read(contact_id=contact_id))
+        return results
+
+    assert run(scenario()) == [2, 2, 2, 0, 0]
+
+
+def test_group_unread_is_separate_from_direct(db):
+    async def scenario():
+        contact_id = await add_peer(db)
+        group_pk = await db.create_group('group001', 'team', ['peer0001'])
+        await db.add_message(contact_id=contact_id, content='in group', group_id=group_pk)
+        await db.add_message(contact_id=contact_id, content='direct')
+        await db.mark_read(group_id=group_pk)
+        group = (await db.get_groups())[0]
+        return group, await contact_summary(db)
+
+    group, summary = run(scenario())
+    assert group['unread_count'] == 0
+    assert group['last_snippet'] == 'in group'
+    assert summary['unread_count'] == 1
+    assert summary['last_snippet'] == 'direct'
+
+
+def test_rebuilt_summaries_match_incremental_ones(db):
+    async def scenario():
+        contact_id = await add_peer(db)
+        group_pk = await db.create_group('group001', 'team', ['peer0001'])
+        ids = [await db.add_message(contact_id=contact_id, content=str(i)) for i in range(5)]
+        await db.add_message(contact_id=contact_id, content='g', group_id=group_pk)
+        await db.add_message(contact_id=contact_id, content='out', is_outgoing=True)
+        await db.mark_read(contact_id=contact_id, up_to_id=ids[2])
+        before = await db.get_contacts(), await db.get_groups()
+        # init_db rebuilds the table from the messages when it is missing
+        async with aiosqlite.connect(db.db_path) as conn:
+            await conn.execute('DROP TABLE conversations')
+            await conn.commit()
+        await db.init_db()
+        return before, (await db.get_contacts(), await db.get_groups())
+
+    before, after = run(scenario())
+    assert before == after
+
+def test_same_msg_uid_is_stored_once(db):
+    async def scenario():
+        contact_id = await add_peer(db)
+        first = await db.add_message(contact_id=contact_id, content='hi', msg_uid='uid-1')
+        second = await db.add_message(contact_id=contact_id, content='hi', msg_uid='uid-1')
+        return first, second, await db.get_messages(contact_id), await contact_summary(db)
+
+    first, second, messages, summary = run(scenario())
+    assert first is not None
+    assert second is None
+    assert len(messages) == 1
+    assert summary['unread_count'] == 1
+
+
+def test_messages_from_before_msg_uid_are_backfilled(tmp_path):
+    path = str(tmp_path / 'old.db')
+
+    async def scenario():
+        # Schema as it was before group_id, is_outgoing and msg_uid were added
+        async with aiosqlite.connect(path) as conn:
+            await conn.execute('''
+                CREATE TABLE contacts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    node_id TEXT UNIQUE NOT NULL,
+                    name TEXT NOT NULL,
+                    ip_address TEXT,
+                    port INTEGER,
+                    public_key TEXT,
+                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    is_online BOOLEAN DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            await conn.execute('''
+                CREATE TABLE messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    contact_id INTEGER,
+                    message_type TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    encrypted_content TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    is_delivered BOOLEAN DEFAULT FALSE,
+                    is_read BOOLEAN DEFAULT FALSE
+                )
+            ''')
+            await conn.execute("INSERT INTO contacts (node_id, name) VALUES ('peer0001', 'old')")
+            await conn.executemany('''
+                INSERT INTO messages (contact_id, message_type, content, timestamp)
+                VALUES (1, 'text', ?, '2024-01-01 12:00:00')
+            ''', [('a',), ('b',), ('b',)])
+            await conn.commit()
+
+        database = Database(path)
+        await database.init_db()
+        async with aiosqlite.connect(path) as conn:
+            cursor = await conn.execute('SELECT id, content, msg_uid FROM messages ORDER BY id')
+            rows = await cursor.fetchall()
+        await database.init_db()
+        async with aiosqlite.connect(path) as conn:
+            cursor = await conn.execute('SELECT id, content, msg_uid FROM messages ORDER BY id')
+            again = await cursor.fetchall()
+        return rows, again
+
+    rows, again = run(scenario())
+    assert rows[0][2] == derive_uid('peer0001', None, '2024-01-01 12:00:00', 'a')
+    assert rows[1][2] == derive_uid('peer0001', None, '2024-01-01 12:00:00', 'b')
+    # The identical third message still gets its own ID
+    assert len({uid for _, _, uid in rows}) == 3
+    assert again == rows
+
+
+def test_importing_an_export_twice_adds_nothing(db, tmp_path):
+    async def scenario():
+        contact_id = await add_peer(db)
+        await db.add_message(contact_id=contact_id, content='with uid', msg_uid='uid-1')
+        await db.add_message(contact_id=contact_id, content='without uid')
+        records = [record async for record in db.export_rows()]
+
+        async def replay():
+            for record in records:
+                yield record
+
+        target = Database(str(tmp_path / 'copy.db'))
+        await target.init_db()
+        await target.import_rows(replay())
+        await target.import_rows(replay())
+        await db.import_rows(replay())
+        copy_id = (await target.get_contact_by_node_id('peer0001'))['id']
+        return await db.get_messages(contact_id), await target.get_messages(copy_id)
+
+    original, copy = run(scenario())
+    assert len(original) == 2
+    assert sorted(m['content'] for m in copy) == ['with uid', 'without uid']
+
+def test_contact_upsert_keeps_row_id(db):
+    async def scenario():
+        contact_id = await add_peer(db)
+        await db.create_group('group001', 'team', ['peer0001'])
+        await db.add_message(contact_id=contact_id, content='before')
+        await db.add_contact('peer0001', 'Renamed', '10.0.0.9', 3000)
+        await db.add_contact('peer0001', 'Renamed')
+        contact = await db.get_contact_by_node_id('peer0001')
+        members = (await db.get_group('group001'))['members']
+        return contact_id, contact, await db.get_messages(contact['id']), members
+
+    contact_id, contact, messages, members = run(scenario())
+    assert contact['id'] == contact_id
+    assert contact['name'] == 'Renamed'
+    # Address fields left out of an update keep their previous values
+    assert (contact['ip_address'], contact['port']) == ('10.0.0.9', 3000)
+    assert [m['content'] for m in messages] == ['before']
+    assert members == ['peer0001']
\ No newline at end of file
@@ -0,0 +1,79 @@
+import asyncio
+import socket
+
+# Largest UDP datagram read from the socket
+RECV_BUFFER = 65535
+
+
+class Transport:
+    """Datagram transport used by P2PNetwork.
+
+    Implementations deliver raw datagrams; addressing is the usual
+    (host, port) tuple and broadcast addresses are passed through as-is.
+    """
+
+    def sendto(self, data, addr):
+        """Send one datagram, raising OSError on failure"""
+        raise NotImplementedError
+
+    def sendto_many(self, data, addrs):
+        """Send the same datagram to several addresses; returns the addresses that failed"""
+        failed = []
+        for addr in addrs:
+            try:
+                self.sendto(data, addr)
+            except OSError:
+                failed.append(addr)
+        return failed
+
+    def sendmsg(self, buffers, addr):
+        """Send one datagram gathered from several buffers"""
+        self.sendto(b''.join(buffers), addr)
+
+    async def recvfrom(self, bufsize):
+        """Wait for the next datagram; returns (data, addr)"""
+        raise NotImplementedError
+
+    async def public_address(self):
+        """Externally visible (ip, port) if the transport knows it, else None"""
+        return None
+
+    def close(self):
+        pass
+
+
+class UDPTransport(Transport):
+    """Real UDP socket bound to host:port"""
+
+    def __init__(self, host='0.0.0.0', port=2948):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+
+    def sendto(self, data, addr):
+        self.sock.sendto(data, addr)
+
+    def sendmsg(self, buffers, addr):
+        # Scatter/gather: header and payload view go to the kernel without a join
+        self.sock.sendmsg(buffers, (), 0, addr)
+
+    def sendto_many(self, data, addrs):
+        # Still one sendto() system call per address: Python's socket module
+        # has no sendmmsg(). Only the encoded bytes and the lookup are shared.
+        sendto = self.sock.sendto
+        failed = []
+        for addr in addrs:
+            try:
+                sendto(data, addr)
+            except OSError:
+                failed.append(addr)
+        return failed
+
+    async def recvfrom(self, bufsize):
+        loop = asyncio.get_running_loop()
+        return await loop.sock_recvfrom(self.sock, bufsize)
+
+    def close(self):
+        self.sock.close()
\ No newline at end of file